@@ -0,0 +1,88 @@
+"""Compare low-resolution heat field rendering against the full-resolution path.
+
+Renders synthetic click layouts with composite_heatmap at heat_scale 1 and at each
+downscale factor, then reports per-frame time and the pixel error of the blended
+frame. Exits non-zero if any factor up to --max-scale exceeds the error threshold.
+
+    python benchmarks/heat_scale_error.py [--width 1280 --height 720]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import heatmap  # noqa: E402
+
+# Mean absolute error (0-255 levels) and PSNR the downscaled paths must stay within
+MAX_MEAN_ABS_ERROR = 1.0
+MIN_PSNR_DB = 35.0
+
+SCENES = {
+    'single_click': 1,
+    'sparse_taps': 5,
+    'busy_frame': 60,
+    'aggregate': 5000,
+}
+
+def synthetic_frame(w, h, rng):
+    """Darkened textured background, like a real video frame after the 0.5 darken"""
+    gradient = np.linspace(0, 127, w, dtype=np.float32)[None, :, None]
+    noise = rng.normal(0, 12, (h, w, 3)).astype(np.float32)
+    return np.clip(gradient + noise + 20, 0, 127).astype(np.uint8)
+
+def synthetic_points(n, w, h, rng):
+    """Unique click pixels with brightness in (0, 1], clustered like real gaze data"""
+    centers = rng.uniform((0.1 * w, 0.1 * h), (0.9 * w, 0.9 * h), (max(1, n // 50), 2))
+    picks = centers[rng.integers(0, len(centers), n)] + rng.normal(0, 0.05 * w, (n, 2))
+    xs = np.clip(picks[:, 0], 0, w - 1).astype(np.intp)
+    ys = np.clip(picks[:, 1], 0, h - 1).astype(np.intp)
+    cells = np.unique(ys * w + xs)
+    values = rng.uniform(0.05, 1.0, len(cells)).astype(np.float32)
+    return cells % w, cells // w, values
+
+def time_render(darkened, xs, ys, values, heat_scale, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = heatmap.composite_heatmap(darkened, xs, ys, values, heat_scale=heat_scale)
+    return result, (time.perf_counter() - start) / repeats
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+def main():
+    parser = argparse.ArgumentParser(description='Low-resolution heat field error benchmark')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-scale', type=int, default=4, help='Largest factor held to the threshold')
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(0)
+    darkened = synthetic_frame(args.width, args.height, rng)
+    failed = False
+    
+    print(f"Thresholds: mean abs error <= {MAX_MEAN_ABS_ERROR}, PSNR >= {MIN_PSNR_DB} dB")
+    for scene, n in SCENES.items():
+        xs, ys, values = synthetic_points(n, args.width, args.height, rng)
+        reference, base_time = time_render(darkened, xs, ys, values, 1, args.repeats)
+        print(f"{scene} ({len(values)} points): full resolution {base_time * 1000:.1f} ms")
+        
+        for heat_scale in (2, 4, 8):
+            result, elapsed = time_render(darkened, xs, ys, values, heat_scale, args.repeats)
+            error = np.abs(result.astype(np.int16) - reference)
+            mean_error, quality = float(error.mean()), psnr(result, reference)
+            within = mean_error <= MAX_MEAN_ABS_ERROR and quality >= MIN_PSNR_DB
+            if heat_scale <= args.max_scale and not within:
+                failed = True
+            print(f"  1/{heat_scale}: {elapsed * 1000:.1f} ms ({base_time / elapsed:.1f}x), "
+                  f"mean abs error {mean_error:.3f}, max {int(error.max())}, PSNR {quality:.1f} dB"
+                  f"{'' if within else ' (over threshold)'}")
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Synthetic benchmarks for the heatmap and detection pipelines.
+
+Generates ffmpeg testsrc videos and synthetic click data, then times load_json_files,
+composite_frame, generate_heatmap and _detect_objects (with a stub detector
+standing in for YOLO, so no GPU or model download is needed). Every case runs in a fresh
+process so its peak RSS is its own. Results are written as JSON; pass --compare with an
+earlier results file to print the speed ratio of each case.
+
+    python benchmarks/run_benchmarks.py [--resolutions 480p 720p --durations 5 --clicks 10 1000]
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/bench_<timestamp>.json
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import heatmap  # noqa: E402
+
+RESOLUTIONS = {'480p': (854, 480), '720p': (1280, 720), '1080p': (1920, 1080)}
+FPS = 30
+CLICKS_PER_SESSION = 500  # Session file size for the load_json_files stage
+STUB_CLASSES = 80
+
+def make_video(path, w, h, seconds):
+    """testsrc video with a sine audio track, like a recorded session"""
+    subprocess.run(['ffmpeg', '-y', '-v', 'error',
+                    '-f', 'lavfi', '-i', f'testsrc=size={w}x{h}:rate={FPS}:duration={seconds}',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', '-shortest', path], check=True)
+
+def synthetic_clicks(n, duration, seed=0):
+    """n clicks clustered around a few targets, spread over duration seconds"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0.1, 0.9, (max(1, n // 200), 2))
+    points = np.clip(centers[rng.integers(0, len(centers), n)] + rng.normal(0, 0.04, (n, 2)), 0, 0.999)
+    timestamps = np.sort(rng.uniform(0, duration, n))
+    return [{'x': x, 'y': y, 'timestamp': t} for (x, y), t in zip(points.tolist(), timestamps.tolist())]
+
+class StubBoxes:
+    """Mimics ultralytics Boxes: tensors are plain arrays with .cpu().numpy()"""
+    def __init__(self, xywhn, conf, cls):
+        self.xywhn, self.conf, self.cls = (StubTensor(a) for a in (xywhn, conf, cls))
+
+    def __len__(self):
+        return len(self.conf.array)
+
+class StubTensor:
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+class StubDetector:
+    """Stands in for YOLO: returns `boxes` slowly drifting detections after `latency` seconds"""
+    names = {i: f"class_{i}" for i in range(STUB_CLASSES)}
+
+    def __init__(self, boxes, latency=0.0, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.latency = latency
+        self.xywhn = np.column_stack([self.rng.uniform(0.2, 0.8, (boxes, 2)), self.rng.uniform(0.05, 0.3, (boxes, 2))])
+        self.conf = self.rng.uniform(0.5, 1.0, boxes)
+        self.cls = self.rng.integers(0, STUB_CLASSES, boxes).astype(np.float32)
+
+    def __call__(self, frame, conf=0.5, iou=0.45, verbose=False):
+        if self.latency:
+            time.sleep(self.latency)
+        self.xywhn[:, :2] += self.rng.normal(0, 0.002, (len(self.xywhn), 2))
+        return [StubResult(StubBoxes(self.xywhn.copy(), self.conf.copy(), self.cls.copy()))]
+
+def _isolate(work_dir, jobs):
+    """Point heatmap's output and caches at work_dir so runs never touch ~/Desktop/Heatmap"""
+    heatmap.OUTPUT_DIR = os.path.join(work_dir, "output")
+    heatmap.CACHE_DIR = os.path.join(work_dir, "cache")
+    heatmap.heatmap_cache = heatmap.HeatmapCache(heatmap.CACHE_DIR, 0)
+    heatmap.RENDER_JOBS = jobs
+
+def peak_rss_mb():
+    """Peak RSS of this process and of its finished children (ffmpeg), in MB"""
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KB on Linux
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+def bench_load_json_files(work_dir, clicks, **_):
+    folder = os.path.join(work_dir, f"sessions_{clicks}")
+    os.makedirs(folder, exist_ok=True)
+    click_data = synthetic_clicks(clicks, 60)
+    for i, start in enumerate(range(0, clicks, CLICKS_PER_SESSION)):
+        with open(os.path.join(folder, f"participant_{i:04d}.json"), 'w') as f:
+            json.dump({'user_name': f"p{i}", 'precision_score': 1.0,
+                       'click_data': click_data[start:start + CLICKS_PER_SESSION]}, f)
+
+    stages = {}
+    for run in ('cold', 'warm'):  # Warm re-reads the ingest index instead of parsing
+        start = time.perf_counter()
+        sessions = heatmap.load_json_files(folder)
+        stages[run] = time.perf_counter() - start
+    assert len(sessions['x']) == clicks
+    return {'wall_seconds': stages['cold'], 'stages': stages,
+            'files': -(-clicks // CLICKS_PER_SESSION), 'clicks_per_second': clicks / stages['cold']}
+
+def bench_composite_frame(work_dir, resolution, clicks, repeats, **_):
+    """One second of fading clicks composited the way render workers do, into reused buffers"""
+    w, h = RESOLUTIONS[resolution]
+    spans, fade_duration = heatmap.build_click_spans(synthetic_clicks(clicks, 1), w, h, FPS, FPS)
+    max_brightness = heatmap.max_frame_brightness(spans, fade_duration, FPS)
+    points = [(xs, ys, values) for _, xs, ys, values in
+              heatmap.iter_frame_points(spans, fade_duration, max_brightness, 0, FPS)]
+    frame = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    buffers = heatmap.CompositeBuffers(w, h)
+    for xs, ys, values in points:  # Warm up the kernel and LUT caches
+        heatmap.composite_frame(frame, xs, ys, values, buffers)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for xs, ys, values in points:
+            heatmap.composite_frame(frame, xs, ys, values, buffers)
+    wall = time.perf_counter() - start
+    frames = repeats * len(points)
+    return {'wall_seconds': wall, 'seconds_per_frame': wall / frames, 'frames_per_second': frames / wall}
+
+def bench_generate_heatmap(work_dir, resolution, duration, clicks, video_path, **_):
+    stages, current = {}, [None, time.perf_counter()]
+
+    def on_progress(stage, percent):
+        now = time.perf_counter()
+        if stage != current[0]:
+            if current[0] is not None:
+                stages[current[0]] = stages.get(current[0], 0.0) + now - current[1]
+            current[:] = [stage, now]
+
+    tracking_data = {'user_name': 'bench', 'click_data': synthetic_clicks(clicks, duration)}
+    start = time.perf_counter()
+    output = heatmap.generate_heatmap(video_path, tracking_data, progress_callback=on_progress)
+    wall = time.perf_counter() - start
+    if current[0] is not None:
+        stages[current[0]] = stages.get(current[0], 0.0) + time.perf_counter() - current[1]
+    if output is None:
+        raise RuntimeError("generate_heatmap returned None")
+    frames = duration * FPS
+    return {'wall_seconds': wall, 'stages': stages, 'frames': frames, 'frames_per_second': frames / wall}
+
+def bench_detect_objects(work_dir, resolution, frames, boxes, latency, **_):
+    w, h = RESOLUTIONS[resolution]
+    system = heatmap.ObjectDetectionSystem()
+    system.detection_model = StubDetector(boxes, latency)
+    system.class_names = dict(StubDetector.names)
+    system.system_initialized = True
+    system.session_log.clear(system.class_names)
+    frame = np.zeros((h, w, 3), dtype=np.uint8)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        system._detect_objects(frame, i / FPS)
+    wall = time.perf_counter() - start
+    system.session_log.append(*system.tracker.flush())
+    return {'wall_seconds': wall, 'frames': frames, 'frames_per_second': frames / wall,
+            'logged_rows': len(system.session_log)}
+
+BENCHMARKS = {
+    'load_json_files': bench_load_json_files,
+    'composite_frame': bench_composite_frame,
+    'generate_heatmap': bench_generate_heatmap,
+    'detect_objects': bench_detect_objects,
+}
+
+def run_case(name, work_dir, jobs, params):
+    """Run one benchmark in this (fresh) process with heatmap's logging silenced"""
+    _isolate(work_dir, jobs)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = BENCHMARKS[name](work_dir, **params)
+    result['peak_rss_mb'], result['peak_child_rss_mb'] = peak_rss_mb()
+    return result
+
+def cases(args, videos):
+    """(benchmark, case name, params) for every requested combination"""
+    for clicks in args.clicks:
+        yield 'load_json_files', f"{clicks}_clicks", {'clicks': clicks}
+    for resolution in args.resolutions:
+        for clicks in args.clicks:
+            yield ('composite_frame', f"{resolution}_{clicks}_clicks",
+                   {'resolution': resolution, 'clicks': clicks, 'repeats': args.repeats})
+    for resolution in args.resolutions:
+        for duration in args.durations:
+            for clicks in args.clicks:
+                yield ('generate_heatmap', f"{resolution}_{duration}s_{clicks}_clicks",
+                       {'resolution': resolution, 'duration': duration, 'clicks': clicks,
+                        'video_path': videos.get((resolution, duration))})
+    for resolution in args.resolutions:
+        yield ('detect_objects', f"{resolution}_{args.boxes}_boxes",
+               {'resolution': resolution, 'frames': args.detect_frames, 'boxes': args.boxes,
+                'latency': args.stub_latency / 1000})
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'opencv': heatmap.cv2.__version__, 'commit': commit}
+
+def compare(results, baseline_path):
+    """Print each case's speed relative to an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = {(r['benchmark'], r['case']): r for r in json.load(f)['results']}
+    print(f"\nCompared with {baseline_path} (>1x is faster now):")
+    for r in results:
+        old = baseline.get((r['benchmark'], r['case']))
+        if not old or 'error' in r or 'error' in old:
+            continue
+        # Throughput where there is one, so runs with different frame counts still compare
+        key = 'frames_per_second' if 'frames_per_second' in r else None
+        speedup = r[key] / old[key] if key else old['wall_seconds'] / r['wall_seconds']
+        print(f"  {r['benchmark']} {r['case']}: {speedup:.2f}x, "
+              f"peak RSS {old['peak_rss_mb']} -> {r['peak_rss_mb']} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic heatmap and detection pipeline benchmarks')
+    parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument('--durations', nargs='+', type=int, default=[5, 30], help='Video lengths in seconds')
+    parser.add_argument('--clicks', nargs='+', type=int, default=[10, 1000, 10000, 100000])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Run only these benchmarks')
+    parser.add_argument('--jobs', type=int, default=1, help='Render jobs for generate_heatmap')
+    parser.add_argument('--repeats', type=int, default=3, help='Passes over the one-second composite_frame clip per case')
+    parser.add_argument('--detect-frames', type=int, default=300)
+    parser.add_argument('--boxes', type=int, default=20, help='Stub detections per frame')
+    parser.add_argument('--stub-latency', type=float, default=0.0, help='Simulated inference time per frame (ms)')
+    parser.add_argument('--output', help='Results file (default benchmarks/results/bench_<timestamp>.json)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    work_dir = tempfile.mkdtemp(prefix="heatmap_bench_")
+    spawn = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        videos = {}
+        if not args.only or 'generate_heatmap' in args.only:
+            for resolution in args.resolutions:
+                for duration in args.durations:
+                    path = os.path.join(work_dir, f"testsrc_{resolution}_{duration}s.mp4")
+                    make_video(path, *RESOLUTIONS[resolution], duration)
+                    videos[resolution, duration] = path
+
+        for name, case, params in cases(args, videos):
+            if args.only and name not in args.only:
+                continue
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                try:
+                    result = pool.submit(run_case, name, work_dir, args.jobs, params).result()
+                except Exception as e:
+                    result = {'error': str(e)}
+            entry = {'benchmark': name, 'case': case,
+                     'params': {k: v for k, v in params.items() if k != 'video_path'}, **result}
+            results.append(entry)
+
+            if 'error' in result:
+                print(f"{name} {case}: failed ({result['error']})")
+            else:
+                rate = f", {result['frames_per_second']:.1f} frames/s" if 'frames_per_second' in result else ""
+                print(f"{name} {case}: {result['wall_seconds']:.3f} s{rate}, peak RSS {result['peak_rss_mb']} MB")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'environment': environment(),
+                   'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+                   'results': results}, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    sys.exit(1 if any('error' in r for r in results) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,640 @@
-import matplotlib
-matplotlib.use('Agg')
+import time
+_PROCESS_START = time.perf_counter()  # Cold-start reference, taken before the heavier imports
+
 import numpy as np
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, request, send_file, jsonify, Response, g
 from flask_cors import CORS
 import cv2
 import tempfile
 import os
 import json
 import subprocess
-import time
 from datetime import datetime
 import threading
 import socket
-from zeroconf import ServiceInfo, Zeroconf
 import uuid
-import queue
 import shutil
 import sys
 import argparse
 import glob
 import re
+import struct
+import bisect
+import functools
+import hashlib
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import atexit
+import io
+import zipfile
+import contextlib
+import cProfile
 
 # Configuration
 OUTPUT_DIR = os.path.expanduser("~/Desktop/Heatmap")
+RENDER_JOBS = 1  # Worker processes used to render heatmap segments
+HEAT_SCALE = 1  # Heat field is splatted at 1/HEAT_SCALE resolution, then upsampled for blending
+BASE_SIGMA = 40  # Gaussian sigma in pixels at 1920 wide, scaled with the output width
+COLORMAP = "inferno"  # OpenCV colormap name (cv2.COLORMAP_<NAME>)
+OVERLAY_OPACITY = 0.8  # Weight of the colored heat over the darkened frame
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "itrace_uploads")
+UPLOAD_STALL_TIMEOUT = 300  # Seconds without new bytes before an in-progress upload is given up on
+CACHE_MAX_BYTES = 2 * 1024**3  # Rendered heatmaps kept for identical resubmissions (0 disables)
+STARTUP_LOG = os.path.join(OUTPUT_DIR, "startup_times.jsonl")
+SESSION_LOG_MEMORY_BYTES = 64 * 1024**2  # Detection rows held in RAM before older chunks spill to disk
+SESSION_JSON = True  # Write a compact JSON copy of each detection session next to its .npz
+DETECTOR_PROCESS = False  # Run YOLO in a separate process that reads frames from shared memory
+PROFILE_DIR = None  # When set, requests with ?profile=1 dump a cProfile .prof file here
+PREVIEW_SIZE = (640, 360)  # quality=preview renders fit this size
+PREVIEW_FPS = 10  # and run at most this frame rate
+
+_IMPORTS_DONE = time.perf_counter()
 
 # Global state
 app = Flask(__name__)
 CORS(app)
 
+def record_startup_time(mode, **stages):
+    """Print cold-start timings (seconds) and append them to STARTUP_LOG to track them over time"""
+    entry = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "mode": mode,
+        "imports": round(_IMPORTS_DONE - _PROCESS_START, 3),
+        **{stage: round(seconds, 3) for stage, seconds in stages.items()}
+    }
+    print(f"Startup ({mode}): " + ", ".join(f"{k} {v}s" for k, v in entry.items() if k not in ("timestamp", "mode")))
+    try:
+        os.makedirs(os.path.dirname(STARTUP_LOG), exist_ok=True)
+        with open(STARTUP_LOG, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"Could not write startup log: {e}")
+
+class StageMetrics:
+    """Latency histograms per pipeline stage, exported in the Prometheus text format.
+    
+    Observations are bucketed as they arrive, so memory stays fixed however many frames
+    are timed. Render segment workers send their snapshot() back to be merge()d.
+    """
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> [per-bucket counts (last one is +Inf), sum of seconds]
+    
+    def observe(self, stage, seconds):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            entry[1] += seconds
+    
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    def snapshot(self):
+        with self.lock:
+            return {stage: [list(counts), total] for stage, (counts, total) in self.stages.items()}
+    
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, (counts, total) in snapshot.items():
+                entry = self.stages.setdefault(stage, [[0] * (len(self.BUCKETS) + 1), 0.0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+    
+    def clear(self):
+        with self.lock:
+            self.stages = {}
+    
+    def render(self, name="itrace_stage_duration_seconds"):
+        """Histogram lines for every observed stage (cumulative le buckets, _sum and _count)"""
+        lines = [f"# HELP {name} Time spent per call in each pipeline stage.", f"# TYPE {name} histogram"]
+        for stage, (counts, total) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+# Global stage timings served on /metrics
+stage_metrics = StageMetrics()
+
+@contextlib.contextmanager
+def profiled(name, enabled=True):
+    """cProfile the enclosed code (this thread only) into PROFILE_DIR/<name>_<time>.prof"""
+    if not (PROFILE_DIR and enabled):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Python 3.12+ allows one active profiler per process (e.g. two profiled jobs at once)
+        print(f"Skipping profile {name}: {e}")
+        profiler = None
+    if profiler is None:
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}")
+
+class SessionLog:
+    """Append-only columnar detection log (timestamp, class id, confidence, bbox, track id).
+    
+    Rows fill fixed-size chunks; once the sealed chunks exceed memory_budget bytes the
+    oldest ones are spilled to disk, so long sessions stay bounded in RAM.
+    """
+    CHUNK_ROWS = 16384
+    
+    def __init__(self, memory_budget=None):
+        self.memory_budget = SESSION_LOG_MEMORY_BYTES if memory_budget is None else memory_budget
+        self.lock = threading.Lock()
+        self.spill_dir = None
+        self.class_names = {}
+        self._reset()
+    
+    def _new_chunk(self):
+        return {
+            "timestamp": np.empty(self.CHUNK_ROWS, np.float64),
+            "class_id": np.empty(self.CHUNK_ROWS, np.int16),
+            "confidence": np.empty(self.CHUNK_ROWS, np.float32),
+            "bbox": np.empty((self.CHUNK_ROWS, 4), np.float32),
+            "track_id": np.empty(self.CHUNK_ROWS, np.int32)
+        }
+    
+    def _reset(self):
+        self.chunks = []  # Sealed chunks: column dicts in memory, or paths of spilled .npz files
+        self.memory_bytes = 0
+        self.current = self._new_chunk()
+        self.current_rows = 0
+        self.rows = 0
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+    
+    def clear(self, class_names=None):
+        """Drop all rows (and spill files) and start a new session"""
+        with self.lock:
+            self._reset()
+            self.class_names = dict(class_names or {})
+    
+    def __len__(self):
+        return self.rows
+    
+    def append(self, timestamps, class_ids, confidences, bboxes, track_ids):
+        """Append detection rows; bboxes is an (n, 4) array of normalized x, y, width, height"""
+        n = len(class_ids)
+        timestamps = np.broadcast_to(timestamps, (n,))
+        with self.lock:
+            pos = 0
+            while pos < n:
+                take = min(n - pos, self.CHUNK_ROWS - self.current_rows)
+                rows = slice(self.current_rows, self.current_rows + take)
+                self.current["timestamp"][rows] = timestamps[pos:pos + take]
+                self.current["class_id"][rows] = class_ids[pos:pos + take]
+                self.current["confidence"][rows] = confidences[pos:pos + take]
+                self.current["bbox"][rows] = bboxes[pos:pos + take]
+                self.current["track_id"][rows] = track_ids[pos:pos + take]
+                self.current_rows += take
+                self.rows += take
+                pos += take
+                if self.current_rows == self.CHUNK_ROWS:
+                    self._seal_chunk()
+    
+    def _seal_chunk(self):
+        self.chunks.append(self.current)
+        self.memory_bytes += sum(column.nbytes for column in self.current.values())
+        self.current = self._new_chunk()
+        self.current_rows = 0
+        
+        for i, chunk in enumerate(self.chunks):
+            if self.memory_bytes <= self.memory_budget:
+                break
+            if isinstance(chunk, dict):
+                if self.spill_dir is None:
+                    self.spill_dir = tempfile.mkdtemp(prefix="itrace_session_")
+                path = os.path.join(self.spill_dir, f"chunk_{i:06d}.npz")
+                np.savez(path, **chunk)
+                self.chunks[i] = path
+                self.memory_bytes -= sum(column.nbytes for column in chunk.values())
+    
+    def columns(self):
+        """Return all rows as a dict of concatenated column arrays"""
+        with self.lock:
+            parts = []
+            for chunk in self.chunks:
+                if isinstance(chunk, str):
+                    with np.load(chunk) as spilled:
+                        chunk = {name: spilled[name] for name in spilled.files}
+                parts.append(chunk)
+            parts.append({name: column[:self.current_rows] for name, column in self.current.items()})
+            return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    
+    def name_list(self):
+        """Class names indexed by class id"""
+        return [self.class_names.get(i, str(i)) for i in range(max(self.class_names, default=-1) + 1)]
+    
+    def save(self, path, metadata, columns=None):
+        """Write the log and session metadata to a compressed .npz"""
+        columns = self.columns() if columns is None else columns
+        np.savez_compressed(
+            path, class_names=np.array(self.name_list(), dtype=str), metadata=np.array(json.dumps(metadata)), **columns
+        )
+
+def load_session_npz(path):
+    """Read a session written by SessionLog.save into (metadata, columns, class_names)"""
+    with np.load(path) as data:
+        metadata = json.loads(str(data["metadata"]))
+        class_names = data["class_names"].tolist()
+        columns = {name: data[name] for name in ("timestamp", "class_id", "confidence", "bbox", "track_id") if name in data.files}
+    return metadata, columns, class_names
+
+def _class_name(class_names, class_id):
+    return class_names[class_id] if class_id < len(class_names) else str(class_id)
+
+def session_records(columns, class_names):
+    """Expand session columns into the per-detection dicts of the JSON session format"""
+    bbox = np.round(columns["bbox"].astype(np.float64), 4).tolist()
+    return [{
+        "object_name": _class_name(class_names, class_id),
+        "track_id": track_id,
+        "confidence": confidence,
+        "timestamp": timestamp,
+        "bounding_box": {"x": x, "y": y, "width": w, "height": h}
+    } for class_id, track_id, confidence, timestamp, (x, y, w, h) in zip(
+        columns["class_id"].tolist(), columns["track_id"].tolist(),
+        np.round(columns["confidence"].astype(np.float64), 3).tolist(), columns["timestamp"].tolist(), bbox)]
+
+def session_tracks(columns, class_names):
+    """Summarize sampled rows into one run per track: class, first and last timestamp, sample count"""
+    if not len(columns["track_id"]):
+        return []
+    track_ids, first_row, inverse, counts = np.unique(
+        columns["track_id"], return_index=True, return_inverse=True, return_counts=True
+    )
+    first = np.full(len(track_ids), np.inf)
+    last = np.full(len(track_ids), -np.inf)
+    np.minimum.at(first, inverse, columns["timestamp"])
+    np.maximum.at(last, inverse, columns["timestamp"])
+    return [{
+        "track_id": track_id,
+        "object_name": _class_name(class_names, class_id),
+        "first_timestamp": start,
+        "last_timestamp": end,
+        "samples": samples
+    } for track_id, class_id, start, end, samples in zip(
+        track_ids.tolist(), columns["class_id"][first_row].tolist(), first.tolist(), last.tolist(), counts.tolist())]
+
+def bbox_iou(a, b):
+    """Pairwise IoU between (n, 4) and (m, 4) arrays of x, y, width, height boxes"""
+    inter_w = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    inter_h = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return inter / np.maximum(union, 1e-12)
+
+class ObjectTracker:
+    """Greedy IoU/centroid tracker that reduces per-frame detections to sampled track runs.
+    
+    A detection joins the same-class track it overlaps most (IoU >= iou_threshold, or its
+    centre within half the track's box size). A track logs a sample row when it starts,
+    when it has moved (IoU with its last sample < resample_iou), every sample_interval
+    seconds, and at its last sighting once it has been missing for max_missed seconds.
+    """
+    def __init__(self, iou_threshold=0.3, resample_iou=0.7, sample_interval=2.0, max_missed=1.0):
+        self.iou_threshold = iou_threshold
+        self.resample_iou = resample_iou
+        self.sample_interval = sample_interval
+        self.max_missed = max_missed
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.next_id = 0
+        self.tracks = []
+    
+    def update(self, timestamp, class_ids, confidences, bboxes):
+        """Match one frame's detections; returns (track ids per detection, sample rows to log)"""
+        samples = []
+        with self.lock:
+            track_ids = np.full(len(class_ids), -1, np.int32)
+            matched = set()
+            if self.tracks and len(class_ids):
+                track_boxes = np.array([t["bbox"] for t in self.tracks])
+                track_classes = np.array([t["class_id"] for t in self.tracks])
+                iou = bbox_iou(track_boxes, bboxes)
+                distance = np.hypot(
+                    (track_boxes[:, None, 0] + track_boxes[:, None, 2] / 2) - (bboxes[None, :, 0] + bboxes[None, :, 2] / 2),
+                    (track_boxes[:, None, 1] + track_boxes[:, None, 3] / 2) - (bboxes[None, :, 1] + bboxes[None, :, 3] / 2)
+                )
+                gate = track_boxes[:, 2:].max(axis=1)[:, None] / 2
+                score = np.where(
+                    (track_classes[:, None] == class_ids[None, :]) & ((iou >= self.iou_threshold) | (distance <= gate)),
+                    iou + 1e-3 * (1 - np.minimum(distance / np.maximum(gate, 1e-12), 1)), -np.inf
+                )
+                for _ in range(min(score.shape)):
+                    t, d = np.unravel_index(np.argmax(score), score.shape)
+                    if score[t, d] == -np.inf:
+                        break
+                    score[t, :] = -np.inf
+                    score[:, d] = -np.inf
+                    track = self.tracks[t]
+                    track.update(bbox=bboxes[d], confidence=confidences[d], last_seen=timestamp)
+                    track_ids[d] = track["id"]
+                    matched.add(t)
+                    if (timestamp - track["sampled_at"] >= self.sample_interval
+                            or bbox_iou(track["sampled_bbox"][None], bboxes[d][None])[0, 0] < self.resample_iou):
+                        samples.append(self._sample(track))
+            
+            # Tracks not seen for max_missed seconds end with a sample at their last sighting
+            alive = []
+            for i, track in enumerate(self.tracks):
+                if i in matched or timestamp - track["last_seen"] <= self.max_missed:
+                    alive.append(track)
+                elif track["last_seen"] > track["sampled_at"]:
+                    samples.append(self._sample(track))
+            self.tracks = alive
+            
+            for d in np.flatnonzero(track_ids < 0):
+                track = {"id": self.next_id, "class_id": class_ids[d], "bbox": bboxes[d],
+                         "confidence": confidences[d], "last_seen": timestamp}
+                self.next_id += 1
+                self.tracks.append(track)
+                track_ids[d] = track["id"]
+                samples.append(self._sample(track))
+        
+        return track_ids, self._sample_columns(samples)
+    
+    def flush(self):
+        """End every open track; returns the closing sample rows"""
+        with self.lock:
+            samples = [self._sample(t) for t in self.tracks if t["last_seen"] > t["sampled_at"]]
+            self.tracks = []
+        return self._sample_columns(samples)
+    
+    def _sample(self, track):
+        track["sampled_at"] = track["last_seen"]
+        track["sampled_bbox"] = track["bbox"]
+        return track["last_seen"], track["class_id"], track["confidence"], track["bbox"], track["id"]
+    
+    @staticmethod
+    def _sample_columns(samples):
+        """Sample rows as the (timestamps, class_ids, confidences, bboxes, track_ids) arrays SessionLog.append takes"""
+        if not samples:
+            return np.empty(0), np.empty(0, np.int16), np.empty(0), np.empty((0, 4)), np.empty(0, np.int32)
+        timestamps, class_ids, confidences, bboxes, track_ids = zip(*samples)
+        return np.array(timestamps), np.array(class_ids), np.array(confidences), np.array(bboxes), np.array(track_ids)
+
+class FrameRing:
+    """Preallocated ring of frame buffers shared by a capture thread and an analyzer.
+    
+    The writer fills slots in place and publishes them; the analyzer takes a handle on the
+    newest frame only, so nothing is allocated or queued per frame. Counters: captured,
+    analyzed, overwritten (published but replaced before the analyzer took it) and dropped
+    (partially read frames that were discarded).
+    """
+    def __init__(self, shape, slots=3, shared=False):
+        shape = (max(2, slots),) + tuple(shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))) if shared else None
+        self.frames = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf) if shared else np.empty(shape, dtype=np.uint8)
+        self.update = threading.Condition()
+        self.reset()
+    
+    def reset(self):
+        with self.update:
+            self.writing = 0
+            self.latest = None  # Slot of the newest frame the analyzer hasn't taken yet
+            self.held = None  # Slot the analyzer is working on
+            self.captured = self.analyzed = self.overwritten = self.dropped = 0
+    
+    def write_slot(self):
+        """Buffer to read the next frame into: a slot that is neither held nor waiting to be analyzed"""
+        with self.update:
+            slots = len(self.frames)
+            for step in range(1, slots + 1):
+                slot = (self.writing + step) % slots
+                if slot != self.held and slot != self.latest:
+                    break
+            else:
+                slot = self.latest  # Two-slot ring with both busy: replace the waiting frame
+            self.writing = slot
+            return self.frames[slot]
+    
+    def commit(self):
+        """Publish the slot from write_slot as the newest frame"""
+        with self.update:
+            if self.latest is not None and self.latest != self.writing:
+                self.overwritten += 1
+            self.latest = self.writing
+            self.captured += 1
+            self.update.notify()
+    
+    def discard(self):
+        """Give up on a partially read write slot"""
+        with self.update:
+            if self.latest == self.writing:
+                self.latest = None
+                self.overwritten += 1
+            self.dropped += 1
+    
+    def acquire_latest(self, timeout):
+        """Take the newest frame (a view into the ring) or None on timeout; call release() when done"""
+        with self.update:
+            if not self.update.wait_for(lambda: self.latest is not None, timeout):
+                return None
+            self.held, self.latest = self.latest, None
+            self.analyzed += 1
+            return self.frames[self.held]
+    
+    def release(self):
+        with self.update:
+            self.held = None
+    
+    def depth(self):
+        """Frames published but not yet taken by the analyzer (0 or 1)"""
+        with self.update:
+            return int(self.latest is not None)
+    
+    def stats(self):
+        with self.update:
+            return {"captured": self.captured, "analyzed": self.analyzed,
+                    "overwritten": self.overwritten, "dropped": self.dropped}
+
+def _yolo_boxes(model, frame):
+    """Run YOLO on one frame; returns (xywhn, confidences, class ids) arrays over all boxes"""
+    results = model(frame, conf=0.5, iou=0.45, verbose=False)
+    boxes = [result.boxes for result in results if result.boxes is not None and len(result.boxes)]
+    if not boxes:
+        return np.empty((0, 4)), np.empty(0), np.empty(0, np.int64)
+    return (np.concatenate([b.xywhn.cpu().numpy() for b in boxes]).astype(np.float64),
+            np.concatenate([b.conf.cpu().numpy() for b in boxes]).astype(np.float64),
+            np.concatenate([b.cls.cpu().numpy() for b in boxes]).astype(np.int64))
+
+def _detector_worker(shm_name, shape, requests, results):
+    """Detector process: load YOLO, then answer ring slot numbers with box arrays"""
+    try:
+        from ultralytics import YOLO
+        model = YOLO('yolov8l.pt')
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except Exception as e:
+        results.put(("error", str(e)))
+        return
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    results.put(("ready", dict(model.names)))
+    
+    while True:
+        slot = requests.get()
+        if slot is None:
+            break
+        try:
+            results.put(("boxes", _yolo_boxes(model, frames[slot])))
+        except Exception as e:
+            results.put(("error", str(e)))
+    
+    del frames
+    shm.close()
+
+class DetectorProcess:
+    """YOLO inference in a child process that reads frames straight out of a shared FrameRing.
+    
+    Requests are ring slot numbers and results are the raw box arrays, so frames are never
+    pickled. A worker that dies or stops answering is restarted on the next frame; the
+    server only loses that frame's detections.
+    """
+    def __init__(self, ring, load_timeout=300, detect_timeout=30):
+        self.ring = ring
+        self.load_timeout = load_timeout
+        self.detect_timeout = detect_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.class_names = {}
+        self.restarts = 0
+    
+    def start(self):
+        """Start the worker and wait for its model to load; returns False if it couldn't"""
+        # Fresh queues so a result left over from a dead worker can't be mistaken for a new one
+        self.requests = self.context.Queue()
+        self.results = self.context.Queue()
+        self.process = self.context.Process(
+            target=_detector_worker, args=(self.ring.shm.name, self.ring.frames.shape, self.requests, self.results),
+            daemon=True
+        )
+        self.process.start()
+        
+        kind, payload = self._result(self.load_timeout)
+        if kind != "ready":
+            print(f"Detector process failed to start: {payload}")
+            self.stop()
+            return False
+        self.class_names = payload
+        print(f"Detector process {self.process.pid} ready")
+        return True
+    
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.process = None
+    
+    def _result(self, timeout):
+        """Next (kind, payload) from the worker, or an error if it died or timed out"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return self.results.get(timeout=0.5)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return "error", f"exited with code {self.process.exitcode}"
+        return "error", "timed out"
+    
+    def detect(self, slot):
+        """Box arrays for the frame in ring slot `slot`, or None if the worker failed"""
+        if self.process is None or not self.process.is_alive():
+            self.restarts += 1
+            print(f"Restarting detector process (restart {self.restarts})")
+            self.stop()
+            if not self.start():
+                return None
+        
+        self.requests.put(slot)
+        kind, payload = self._result(self.detect_timeout)
+        if kind != "boxes":
+            print(f"Detector process error: {payload}")
+            if not self.process.is_alive() or payload == "timed out":
+                self.stop()  # Restarted on the next frame
+            return None
+        return payload
+
 class ObjectDetectionSystem:
     def __init__(self):
         self.recording_process = None
         self.recording_filepath = None
         self.detection_model = None
+        self.detector = None  # DetectorProcess when DETECTOR_PROCESS is set
+        self.class_names = {}
         self.detection_active = False
-        self.frame_queue = queue.Queue(maxsize=5)
+        self.frame_ring = FrameRing((720, 1280, 3))
         self.analysis_thread = None
         self.latest_detections = []
         self.detection_lock = threading.Lock()
-        self.session_data = []
-        self.session_lock = threading.Lock()
+        self.detection_update = threading.Condition(self.detection_lock)
+        self.detection_seq = 0  # Bumped once per finished inference
+        self.latest_event = None  # JSON of the latest detection set, serialized once for every client
+        self.session_log = SessionLog()
+        self.tracker = ObjectTracker()
         self.ready_time = None
         self.system_initialized = False
-        self._initialize_yolo()
+        self.model_lock = threading.Lock()
+        self.model_load_attempted = False
+    
+    def warm_up(self):
+        """Load the model in the background so the first /start_detection doesn't pay for it"""
+        threading.Thread(target=self._ensure_model, daemon=True).start()
+    
+    def _ensure_model(self):
+        """Load YOLO on first use (torch and ultralytics are only imported here)"""
+        with self.model_lock:
+            if not self.model_load_attempted:
+                self.model_load_attempted = True
+                start = time.perf_counter()
+                if self._start_detector_process() if DETECTOR_PROCESS else self._initialize_yolo():
+                    record_startup_time("model_warmup", model_load=time.perf_counter() - start)
+        return bool(self.class_names)
+    
+    def _start_detector_process(self):
+        """Move the frame ring into shared memory and start the detector process on it"""
+        self.frame_ring = FrameRing(self.frame_ring.frames.shape[1:], len(self.frame_ring.frames), shared=True)
+        atexit.register(self.frame_ring.shm.unlink)
+        detector = DetectorProcess(self.frame_ring)
+        atexit.register(detector.stop)
+        if not detector.start():
+            return False
+        self.detector = detector
+        self.class_names = detector.class_names
+        return True
     
     def _initialize_yolo(self):
         """Initialize YOLO model for object detection"""
@@ -50,6 +642,7 @@ class ObjectDetectionSystem:
             import torch
             from ultralytics import YOLO
             self.detection_model = YOLO('yolov8l.pt')
+            self.class_names = dict(self.detection_model.names)
             print("YOLO model initialized successfully")
             return True
         except ImportError:
@@ -61,20 +654,21 @@ class ObjectDetectionSystem:
     
     def start_detection(self):
         """Start object detection system"""
-        if self.detection_active or self.detection_model is None:
-            return self.detection_model is not None
+        if self.detection_active or not self._ensure_model():
+            return bool(self.class_names)
         
         self.detection_active = True
         self.system_initialized = False
         
         # Clear previous data
-        with self.session_lock:
-            self.session_data.clear()
-        self._clear_frame_queue()
+        self.session_log.clear(self.class_names)
+        with self.tracker.lock:
+            self.tracker.reset()
+        self.frame_ring.reset()
         
         # Start recording and analysis threads
-        threading.Thread(target=self._record_and_analyze, daemon=True).start()
-        self.analysis_thread = threading.Thread(target=self._analyze_frames, daemon=True)
+        threading.Thread(target=self._record_and_analyze, name="detection-capture", daemon=True).start()
+        self.analysis_thread = threading.Thread(target=self._analyze_frames, name="detection-analysis", daemon=True)
         self.analysis_thread.start()
         
         return True
@@ -86,9 +680,8 @@ class ObjectDetectionSystem:
         
         video_path = self._stop_recording()
         
-        with self.detection_lock:
-            self.latest_detections = []
-        self._clear_frame_queue()
+        self._publish_detections([], None)
+        print(f"Capture stats: {self.frame_ring.stats()}")
         
         return video_path
     
@@ -97,10 +690,28 @@ class ObjectDetectionSystem:
         with self.detection_lock:
             return self.latest_detections.copy()
     
+    def _publish_detections(self, detections, frame_timestamp):
+        """Store a new detection set under the next sequence number and wake waiting streams"""
+        with self.detection_update:
+            self.detection_seq += 1
+            self.latest_detections = detections
+            self.latest_event = json.dumps({
+                "seq": self.detection_seq,
+                "frame_timestamp": frame_timestamp,
+                "detections": detections
+            })
+            self.detection_update.notify_all()
+    
+    def wait_for_detections(self, since, timeout):
+        """Block until a detection set newer than seq `since` exists; returns (seq, event JSON) or None on timeout"""
+        with self.detection_update:
+            if self.detection_update.wait_for(lambda: self.detection_seq > since, timeout):
+                return self.detection_seq, self.latest_event
+        return None
+    
     def get_session_data(self):
-        """Get complete session data"""
-        with self.session_lock:
-            return self.session_data.copy()
+        """Get complete session data as column arrays"""
+        return self.session_log.columns()
     
     def _record_and_analyze(self):
         """Record video with audio using SoX for audio and FFmpeg for video"""
@@ -132,20 +743,16 @@ class ObjectDetectionSystem:
             
             self.recording_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=10**8)
             
-            frame_size = 1280 * 720 * 3
             while self.detection_active and self.recording_process:
                 try:
-                    raw_frame = self.recording_process.stdout.read(frame_size)
-                    if len(raw_frame) != frame_size:
+                    if not _read_exact_into(self.recording_process.stdout, self.frame_ring.write_slot()):
+                        self.frame_ring.discard()
                         break
-                    
-                    frame = np.frombuffer(raw_frame, dtype=np.uint8).reshape((720, 1280, 3))
-                    
-                    if not self.frame_queue.full():
-                        self.frame_queue.put(frame)
+                    self.frame_ring.commit()
                         
                 except Exception as e:
                     print(f"Error reading frame: {e}")
+                    self.frame_ring.discard()
                     break
             
             # Stop audio recording
@@ -155,7 +762,7 @@ class ObjectDetectionSystem:
             # Merge video and audio
             merge_cmd = [
                 'ffmpeg', '-i', video_filepath, '-i', audio_filepath,
-                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-y', self.recording_filepath
+                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-movflags', '+faststart', '-y', self.recording_filepath
             ]
             subprocess.run(merge_cmd, capture_output=True)
             
@@ -173,64 +780,69 @@ class ObjectDetectionSystem:
         """Analyze frames for object detection"""
         while self.detection_active:
             try:
-                frame = None
-                # Get latest frame
-                while not self.frame_queue.empty():
-                    frame = self.frame_queue.get()
-                
-                if frame is not None and self.system_initialized:
-                    detections = self._detect_objects(frame)
-                    with self.detection_lock:
-                        self.latest_detections = detections
-                else:
-                    time.sleep(0.1)
+                # Handle on the newest captured frame; older ones were overwritten in the ring
+                frame = self.frame_ring.acquire_latest(timeout=0.1)
+                if frame is None:
+                    continue
+                try:
+                    if self.system_initialized:
+                        frame_timestamp = round(time.time() - self.ready_time, 2)
+                        self._publish_detections(self._detect_objects(frame, frame_timestamp), frame_timestamp)
+                finally:
+                    self.frame_ring.release()
                     
             except Exception as e:
                 print(f"Error in analysis: {e}")
                 time.sleep(1.0)
     
-    def _detect_objects(self, frame):
+    def _detect_objects(self, frame, video_timestamp):
         """Detect objects in frame using YOLO"""
-        if not (self.detection_model and self.system_initialized):
+        if not (self.class_names and self.system_initialized):
             return []
         
         try:
-            results = self.detection_model(frame, conf=0.5, iou=0.45, verbose=False)
-            detections = []
-            video_timestamp = time.time() - self.ready_time if self.ready_time else 0
-            
-            for result in results:
-                if result.boxes is not None:
-                    for box in result.boxes:
-                        class_id = int(box.cls[0])
-                        class_name = self.detection_model.names[class_id]
-                        confidence = float(box.conf[0])
-                        
-                        # Get normalized coordinates
-                        x_center, y_center, bbox_w, bbox_h = box.xywhn[0].tolist()
-                        screen_x = max(0.0, min(1.0, x_center - bbox_w / 2))
-                        screen_y = max(0.0, min(1.0, y_center - bbox_h / 2))
-                        bbox_w = max(0.0, min(1.0 - screen_x, bbox_w))
-                        bbox_h = max(0.0, min(1.0 - screen_y, bbox_h))
-                        
-                        if bbox_w >= 0.01 and bbox_h >= 0.01: 
-                            detection_data = {
-                                "name": class_name,
-                                "confidence": confidence,
-                                "bbox": {"x": screen_x, "y": screen_y, "width": bbox_w, "height": bbox_h}
-                            }
-                            detections.append(detection_data)
-                            
-                            # Log to session data
-                            with self.session_lock:
-                                self.session_data.append({
-                                    "object_name": class_name,
-                                    "confidence": confidence,
-                                    "timestamp": round(video_timestamp, 2),
-                                    "bounding_box": {"x": screen_x, "y": screen_y, "width": bbox_w, "height": bbox_h}
-                                })
-            
-            return sorted(detections, key=lambda x: x['confidence'], reverse=True)[:15]
+            inference_start = time.perf_counter()
+            if self.detector is not None:
+                # The worker reads the frame from the ring slot the analyzer is holding
+                boxes = self.detector.detect(self.frame_ring.held)
+                if boxes is None:
+                    return []
+            else:
+                boxes = _yolo_boxes(self.detection_model, frame)
+            postprocess_start = time.perf_counter()
+            stage_metrics.observe("inference", postprocess_start - inference_start)
+            xywhn, confidences, class_ids = boxes
+            
+            # Normalized top-left corner and size, clipped to the frame
+            screen_x = np.clip(xywhn[:, 0] - xywhn[:, 2] / 2, 0.0, 1.0)
+            screen_y = np.clip(xywhn[:, 1] - xywhn[:, 3] / 2, 0.0, 1.0)
+            bbox_w = np.clip(xywhn[:, 2], 0.0, 1.0 - screen_x)
+            bbox_h = np.clip(xywhn[:, 3], 0.0, 1.0 - screen_y)
+            
+            keep = np.flatnonzero((bbox_w >= 0.01) & (bbox_h >= 0.01))
+            
+            bboxes = np.stack([screen_x, screen_y, bbox_w, bbox_h], axis=1)[keep]
+            class_ids, confidences = class_ids[keep], confidences[keep]
+            
+            # Only track starts, moves, periodic samples and ends reach the session log
+            track_ids, samples = self.tracker.update(video_timestamp, class_ids, confidences, bboxes)
+            self.session_log.append(*samples)
+            
+            # Live view gets the 15 most confident boxes
+            top = np.arange(len(keep))
+            if len(top) > 15:
+                top = np.argpartition(-confidences, 14)[:15]
+            top = top[np.argsort(-confidences[top], kind='stable')]
+            names = self.class_names
+            detections = [{
+                "name": names[class_id],
+                "track_id": track_id,
+                "confidence": confidence,
+                "bbox": {"x": x, "y": y, "width": w, "height": h}
+            } for class_id, track_id, confidence, (x, y, w, h) in zip(
+                class_ids[top].tolist(), track_ids[top].tolist(), confidences[top].tolist(), bboxes[top].tolist())]
+            stage_metrics.observe("postprocess", time.perf_counter() - postprocess_start)
+            return detections
             
         except Exception as e:
             print(f"Error in object detection: {e}")
@@ -249,41 +861,36 @@ class ObjectDetectionSystem:
         
         return self.recording_filepath
     
-    def _clear_frame_queue(self):
-        """Clear frame queue"""
-        while not self.frame_queue.empty():
-            try:
-                self.frame_queue.get_nowait()
-            except:
-                break
-    
     def save_session_data(self, user_data, video_path):
-        """Save session data to JSON file"""
+        """Save session data to an .npz file (plus a compact JSON copy if SESSION_JSON is set)"""
         try:
             os.makedirs(OUTPUT_DIR, exist_ok=True)
             
-            session_detections = self.get_session_data()
-            unique_objects = list(set(d["object_name"] for d in session_detections))
-            
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.session_log.append(*self.tracker.flush())
+            columns = self.get_session_data()
+            class_names = self.session_log.name_list()
             session_data = {
                 "tracking_type": "object_detection",
                 "user_name": user_data.get('user_name', 'unknown_user'),
                 "user_gender": user_data.get('user_gender', 'Unknown'),
                 "user_age": user_data.get('user_age', 0),
-                "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
-                "unique_objects": unique_objects,
-                "detected_objects": session_detections
+                "timestamp": timestamp,
+                "unique_objects": [class_names[i] for i in np.unique(columns["class_id"]).tolist()],
+                "track_count": len(np.unique(columns["track_id"]))
             }
             
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             user_name = user_data.get('user_name', 'unknown_user').replace(' ', '_')
-            json_filename = f"{user_name}_object_detection_{timestamp}.json"
-            json_path = os.path.join(OUTPUT_DIR, json_filename)
+            session_path = os.path.join(OUTPUT_DIR, f"{user_name}_object_detection_{timestamp}.npz")
+            self.session_log.save(session_path, session_data, columns)
             
-            with open(json_path, 'w') as f:
-                json.dump(session_data, f, indent=2)
+            if SESSION_JSON:
+                session_data["tracks"] = session_tracks(columns, class_names)
+                session_data["detected_objects"] = session_records(columns, class_names)
+                with open(os.path.splitext(session_path)[0] + ".json", 'w') as f:
+                    json.dump(session_data, f, separators=(',', ':'))
             
-            return json_path
+            return session_path
             
         except Exception as e:
             print(f"Error saving session data: {e}")
@@ -309,123 +916,957 @@ class ObjectDetectionSystem:
             print(f"Error saving video: {e}")
             return None
 
-# Global detection system instance
+# Global detection system instance (the YOLO model loads lazily)
 detection_system = ObjectDetectionSystem()
 
+def click_columns(click_data):
+    """(x, y, timestamp) float64 arrays from a list of click dicts or a dict of click arrays"""
+    if isinstance(click_data, dict):
+        return tuple(np.asarray(click_data[k], dtype=np.float64) for k in ('x', 'y', 'timestamp'))
+    clicks = [c for c in click_data if 'x' in c and 'y' in c and 'timestamp' in c]
+    return tuple(np.array([float(c[k]) for c in clicks], dtype=np.float64) for k in ('x', 'y', 'timestamp'))
+
+def _parse_session_file(path):
+    """Parse one session file into (x, y, timestamp) arrays and its participant entry (or None)"""
+    participant = None
+    if path.endswith(".npz"):
+        _, columns, _ = load_session_npz(path)
+        bbox = columns["bbox"].astype(np.float64)
+        # Use center of bounding box as click point
+        return bbox[:, 0] + bbox[:, 2] / 2, bbox[:, 1] + bbox[:, 3] / 2, columns["timestamp"].astype(np.float64), None
+    
+    with open(path, 'r') as f:
+        data = json.load(f)
+    
+    if 'click_data' in data:
+        # Direct click data format (a list of clicks, or columns in averaged data files)
+        x, y, t = click_columns(data['click_data'])
+        if 'user_name' in data and 'precision_score' in data:
+            participant = {
+                "user_name": data['user_name'],
+                "click_count": len(x),
+                "precision_score": data['precision_score']
+            }
+    elif 'detected_objects' in data:
+        # Object detection format: use center of bounding box as click point
+        boxes = [(obj['bounding_box'], obj.get('timestamp', 0)) for obj in data['detected_objects'] if 'bounding_box' in obj]
+        x = np.array([b['x'] + b['width'] / 2 for b, _ in boxes], dtype=np.float64)
+        y = np.array([b['y'] + b['height'] / 2 for b, _ in boxes], dtype=np.float64)
+        t = np.array([float(ts) for _, ts in boxes], dtype=np.float64)
+    else:
+        raise ValueError("no recognized click data format")
+    return x, y, t, participant
+
+def _ingest_index_path(folder_path):
+    digest = hashlib.sha1(os.path.abspath(folder_path).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "ingest", f"{digest}.npz")
+
+def _load_ingest_index(folder_path):
+    """Previously parsed files of folder_path: {name: entry} plus their concatenated click arrays"""
+    try:
+        with np.load(_ingest_index_path(folder_path)) as data:
+            return json.loads(str(data["index"])), data["x"], data["y"], data["timestamp"]
+    except (OSError, KeyError, ValueError):
+        return {}, None, None, None
+
+def _save_ingest_index(folder_path, index, x, y, t):
+    path = _ingest_index_path(folder_path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, index=np.array(json.dumps(index)), x=x, y=y, timestamp=t)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save ingest index: {e}")
+
+def list_session_files(folder_path):
+    """Session files (JSON and .npz) in folder_path, sorted by name"""
+    npz_files = glob.glob(os.path.join(folder_path, "*.npz"))
+    # A JSON copy written next to a session's .npz describes the same detections
+    npz_stems = {os.path.splitext(path)[0] for path in npz_files}
+    json_files = [path for path in glob.glob(os.path.join(folder_path, "*.json")) if os.path.splitext(path)[0] not in npz_stems]
+    return sorted(json_files + npz_files)
+
 def load_json_files(folder_path):
-    """Load all JSON files from the specified folder"""
-    json_files = glob.glob(os.path.join(folder_path, "*.json"))
-    all_click_data = []
+    """Load all JSON and .npz session files from the specified folder.
     
-    print(f"Found {len(json_files)} JSON files in {folder_path}")
+    Returns {'x', 'y', 'timestamp', 'source'} click arrays (source indexes 'sources', the file
+    names) and the 'participants' summary ('participant_source' holds each one's source index). Files are parsed in parallel and an index keyed by
+    mtime and size lets re-runs parse only new or changed files.
+    """
+    paths = list_session_files(folder_path)
     
-    for json_file in json_files:
-        try:
-            with open(json_file, 'r') as f:
-                data = json.load(f)
-                
-            print(f"Processing {os.path.basename(json_file)}")
-            
-            # Extract click data
-            if 'click_data' in data:
-                # Direct click data format
-                clicks = data['click_data']
-            elif 'detected_objects' in data:
-                # Object detection format
-                clicks = []
-                for obj in data['detected_objects']:
-                    if 'bounding_box' in obj:
-                        bbox = obj['bounding_box']
-                        # Use center of bounding box as click point
-                        center_x = bbox['x'] + bbox['width'] / 2
-                        center_y = bbox['y'] + bbox['height'] / 2
-                        clicks.append({
-                            'x': center_x,
-                            'y': center_y,
-                            'timestamp': obj.get('timestamp', 0)
-                        })
-            else:
-                print(f"Warning: No recognized click data format in {json_file}")
-                continue
-            
-            # Add clicks to the combined list
-            for click in clicks:
-                if 'x' in click and 'y' in click and 'timestamp' in click:
-                    all_click_data.append({
-                        'x': float(click['x']),
-                        'y': float(click['y']),
-                        'timestamp': float(click['timestamp']),
-                        'source_file': os.path.basename(json_file)
-                    })
-            
-            print(f"Added {len(clicks)} clicks from {os.path.basename(json_file)}")
-            
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
+    print(f"Found {len(paths)} session files in {folder_path}")
     
-    print(f"Total clicks loaded: {len(all_click_data)}")
-    return all_click_data
+    cached_index, cached_x, cached_y, cached_t = _load_ingest_index(folder_path)
+    parsed = {}
+    todo = []
+    for path in paths:
+        name = os.path.basename(path)
+        st = os.stat(path)
+        entry = cached_index.get(name)
+        if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            rows = slice(entry["start"], entry["end"])
+            parsed[name] = (cached_x[rows], cached_y[rows], cached_t[rows], entry["participant"], st)
+        else:
+            todo.append((path, st))
+    
+    def record(path, st, result):
+        parsed[os.path.basename(path)] = (*result, st)
+    
+    # json.load holds the GIL, so big folders are parsed across processes (spawned, since the
+    # server's threads may hold locks a forked child would inherit)
+    if len(todo) > 16:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(todo) // 8, os.cpu_count() or 1),
+                                                    mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(_parse_session_file, path): (path, st) for path, st in todo}
+            for future in concurrent.futures.as_completed(futures):
+                path, st = futures[future]
+                try:
+                    record(path, st, future.result())
+                except Exception as e:
+                    print(f"Error processing {path}: {e}")
+    else:
+        for path, st in todo:
+            try:
+                record(path, st, _parse_session_file(path))
+            except Exception as e:
+                print(f"Error processing {path}: {e}")
+    
+    print(f"Parsed {len(todo)} new or changed files, reused {len(paths) - len(todo)} from the index")
+    
+    sources = [name for name in map(os.path.basename, paths) if name in parsed]
+    index = {}
+    offset = 0
+    for name in sources:
+        x, _, _, participant, st = parsed[name]
+        index[name] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "start": offset,
+                       "end": offset + len(x), "participant": participant}
+        offset += len(x)
+    
+    columns = [np.concatenate([parsed[name][i] for name in sources]) if sources else np.empty(0) for i in range(3)]
+    if todo:
+        _save_ingest_index(folder_path, index, *columns)
+    
+    print(f"Total clicks loaded: {len(columns[0])}")
+    return {
+        'x': columns[0],
+        'y': columns[1],
+        'timestamp': columns[2],
+        'source': np.repeat(np.arange(len(sources), dtype=np.int32), [len(parsed[name][0]) for name in sources]),
+        'sources': sources,
+        'participants': [parsed[name][3] for name in sources if parsed[name][3]],
+        'participant_source': [i for i, name in enumerate(sources) if parsed[name][3]]
+    }
+
+VIDEO_EXTENSIONS = ['*.mp4', '*.avi', '*.mov', '*.mkv', '*.flv', '*.wmv']
+
+def list_video_files(folder_path):
+    """All video files directly in folder_path, in extension preference order"""
+    return [path for ext in VIDEO_EXTENSIONS for path in sorted(glob.glob(os.path.join(folder_path, ext)))]
 
 def find_video_file(folder_path):
     """Find the first video file in the folder"""
-    video_extensions = ['*.mp4', '*.avi', '*.mov', '*.mkv', '*.flv', '*.wmv']
-    
-    for ext in video_extensions:
-        video_files = glob.glob(os.path.join(folder_path, ext))
-        if video_files:
-            print(f"Found video file: {video_files[0]}")
-            return video_files[0]
+    video_files = list_video_files(folder_path)
+    if video_files:
+        print(f"Found video file: {video_files[0]}")
+        return video_files[0]
     
     print(f"No video files found in {folder_path}")
     return None
 
-def reduce_video_quality(input_path, max_width=1280, max_height=720, crf=28):
-    try:
-        cap = cv2.VideoCapture(input_path)
-        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        cap.release()
+def probe_video(video_path):
+    """Read (width, height, fps, frame_count) from the container header"""
+    with stage_metrics.time("probe"):
+        cap = cv2.VideoCapture(video_path)
+        try:
+            if not cap.isOpened():
+                return 0, 0, 0.0, 0
+            return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        finally:
+            cap.release()
+
+def output_size(w, h, max_width=1280, max_height=720):
+    """Render size: downscaled to fit max_width x max_height, even for yuv420p"""
+    scale = min(max_width / w, max_height / h, 1.0)
+    if scale >= 0.95:
+        scale = 1.0
+    return int(w * scale) & ~1, int(h * scale) & ~1
+
+def _read_exact_into(stream, buffer):
+    """Fill buffer from stream, returning False if the stream ends first"""
+    view = memoryview(buffer).cast('B')
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            return False
+        filled += n
+    return True
+
+class FfmpegVideoReader:
+    """Decode and scale a video with ffmpeg straight into BGR frames over a rawvideo pipe"""
+    def __init__(self, video_path, w, h, start_frame=0, fps=None, max_frames=None, feed=None, resample=False):
+        """feed: optional iterable of byte chunks piped to ffmpeg instead of reading video_path.
+        resample: convert the video to fps (dropping frames) instead of passing its frames through.
+        """
+        self.w, self.h = w, h
+        cmd = ['ffmpeg', '-v', 'error']
+        if start_frame > 0:
+            # Half a frame early so accurate seeking lands exactly on start_frame
+            cmd += ['-ss', f"{(start_frame - 0.5) / fps:.6f}"]
+        cmd += ['-i', 'pipe:0' if feed is not None else video_path,
+                '-map', '0:v:0', '-vf', f'scale={w}:{h}' + (f',fps={fps}' if resample else ''),
+                '-fps_mode', 'passthrough']
+        if max_frames:
+            cmd += ['-frames:v', str(max_frames)]
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed is not None else subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if feed is not None:
+            threading.Thread(target=self._pump, args=(feed,), daemon=True).start()
+    
+    def _pump(self, feed):
+        try:
+            for chunk in feed:
+                self.process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError, OSError):
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+    
+    def read(self, frame=None):
+        """Same contract as cv2.VideoCapture.read: (ret, frame), decoding into frame when one is passed"""
+        if frame is None:
+            frame = np.empty((self.h, self.w, 3), dtype=np.uint8)
+        if not _read_exact_into(self.process.stdout, frame):
+            return False, None
+        return True, frame
+    
+    def release(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'alac', 'opus'}  # Source audio that can be stream-copied into MP4
+
+def _audio_codec_args(audio_source):
+    """-c:a args for muxing audio_source's first audio stream into MP4: copy it when MP4 can hold
+    the codec, otherwise re-encode to AAC (e.g. wmav2 from .wmv, vorbis from .mkv)"""
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-i', audio_source], capture_output=True)
+    match = re.search(r"Stream #\d+:\d+.*?: Audio: (\w+)", result.stderr.decode(errors='replace'))
+    if match and match.group(1) in MP4_AUDIO_CODECS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac']
+
+def _audio_input_args(audio_source, duration, start=0):
+    """ffmpeg args adding audio_source's audio from start seconds, cut to duration, as input 1"""
+    args = ['-ss', f"{start:.6f}"] if start else []
+    args += ['-t', f"{duration:.6f}"] if duration else []
+    return args + ['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?']
+
+class FfmpegVideoWriter:
+    """Encode BGR frames piped over stdin with libx264, muxing audio_source's audio in the same run.
+    
+    Output is fast-start (moov first) so players can begin before the download finishes;
+    intermediate segments can skip that rewrite with faststart=False.
+    """
+    def __init__(self, output_path, w, h, fps, audio_source=None, audio_duration=None, faststart=True,
+                 audio_start=0, preset='veryfast', crf=23):
+        cmd = ['ffmpeg', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{w}x{h}',
+               '-r', str(fps), '-i', '-']
+        if audio_source:
+            cmd += _audio_input_args(audio_source, audio_duration, audio_start) + _audio_codec_args(audio_source)
+        cmd += ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p']
+        if faststart:
+            cmd += ['-movflags', '+faststart']
+        cmd += ['-y', output_path]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+    
+    def release(self):
+        """Finish encoding, returning True if ffmpeg succeeded"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = self.process.stderr.read()
+        self.process.wait()
+        if self.process.returncode != 0:
+            print(f"Failed to encode video: {stderr.decode(errors='replace') if stderr else 'Unknown error'}")
+            return False
+        return True
+
+def heatmap_sigma(video_width, base_sigma=40, base_resolution=1920):
+    """Gaussian sigma in pixels, scaled from the 1920px reference width"""
+    resolution_scale = video_width / base_resolution
+    return max(base_sigma * resolution_scale, 5.0)
+
+@functools.lru_cache(maxsize=16)
+def gaussian_splat_kernel(sigma):
+    """2D Gaussian kernel with the same size and weights cv2.GaussianBlur uses for sigma"""
+    ksize = int(round(sigma * 8 + 1)) | 1
+    g = cv2.getGaussianKernel(ksize, sigma, cv2.CV_32F)
+    kernel = g * g.T
+    kernel.setflags(write=False)
+    return kernel
+
+@functools.lru_cache(maxsize=4)
+def _heatmap_tint(opacity=0.8, colormap=cv2.COLORMAP_INFERNO):
+    """What blending the colormap's zero colour adds to pixels with no heat"""
+    zero_color = cv2.applyColorMap(np.zeros((1, 1), dtype=np.uint8), colormap)[0, 0]
+    return tuple(float(round(opacity * c)) for c in zero_color) + (0.0,)
+
+@functools.lru_cache(maxsize=1)
+def _darken_lut():
+    """256-entry BGR LUT for cv2.LUT, equal to cv2.addWeighted(frame, 0.5, zeros, 0.5, 0)"""
+    levels = np.arange(256, dtype=np.uint8).reshape(256, 1)
+    lut = np.repeat(cv2.addWeighted(levels, 0.5, np.zeros_like(levels), 0.5, 0)[:, :, None], 3, axis=2)
+    lut.setflags(write=False)
+    return lut
+
+@functools.lru_cache(maxsize=4)
+def _darken_tint_lut(opacity=0.8, colormap=cv2.COLORMAP_INFERNO):
+    """Darken and add the colormap's zero-colour tint (as composite_heatmap does outside the heat) in one LUT"""
+    lut = cv2.add(_darken_lut(), _heatmap_tint(opacity, colormap))
+    lut.setflags(write=False)
+    return lut
+
+class CompositeBuffers:
+    """Scratch images one render worker reuses for every frame of a w x h video.
+    
+    With these, composite_frame decodes, darkens, colorizes and blends into preallocated
+    memory, so steady-state rendering allocates nothing per frame beyond the point arrays.
+    The output and decode buffers are overwritten on the next frame.
+    """
+    def __init__(self, w, h, heat_scale=1):
+        self.w, self.h = w, h
+        # Heat is upsampled in whole heat_scale blocks, so it may overhang the frame before cropping
+        self.heat = np.empty((-(-h // heat_scale) * heat_scale, -(-w // heat_scale) * heat_scale), dtype=np.float32)
+        self.low_heat = np.empty((-(-h // heat_scale), -(-w // heat_scale)), dtype=np.float32) if heat_scale > 1 else None
+        self.levels = np.empty((h, w), dtype=np.uint8)
+        self.colored = np.empty((h, w, 3), dtype=np.uint8)
+        self.output = np.empty((h, w, 3), dtype=np.uint8)
+        self.sources = [np.empty((h, w, 3), dtype=np.uint8) for _ in range(2)]  # Decode targets, alternated
+        self.stamp_scratch = np.empty((0, 0), dtype=np.float32)
+    
+    def stamp(self, size):
+        """Scratch of at least size x size for one scaled splat kernel"""
+        if self.stamp_scratch.shape[0] < size:
+            self.stamp_scratch = np.empty((size, size), dtype=np.float32)
+        return self.stamp_scratch
+
+def _mirror_positions(p, size, radius):
+    """Positions whose splat lands on p under cv2's default BORDER_REFLECT_101"""
+    positions = [p]
+    if 0 < p <= radius:
+        positions.append(-p)
+    if size - 1 - radius <= p < size - 1:
+        positions.append(2 * (size - 1) - p)
+    return positions
+
+def _stamp_kernel(heat, kernel, cx, cy, value, scratch=None):
+    """Add kernel * value centred on (cx, cy) in heat coordinates, clipped to heat.
+    
+    scratch: a float32 buffer at least the kernel's size to hold kernel * value, instead of a new array.
+    """
+    r = kernel.shape[0] // 2
+    kx0, ky0 = cx - r, cy - r
+    x0, y0 = max(kx0, 0), max(ky0, 0)
+    x1, y1 = min(kx0 + kernel.shape[1], heat.shape[1]), min(ky0 + kernel.shape[0], heat.shape[0])
+    if x1 > x0 and y1 > y0:
+        patch = kernel[y0 - ky0:y1 - ky0, x0 - kx0:x1 - kx0]
+        if scratch is None:
+            heat[y0:y1, x0:x1] += patch * value
+        else:
+            # cv2 ops on the views skip numpy's iterator buffers; value is rounded to float32 as numpy would
+            scaled, target = scratch[:y1 - y0, :x1 - x0], heat[y0:y1, x0:x1]
+            cv2.multiply(patch, (float(np.float32(value)), 0, 0, 0), dst=scaled)
+            cv2.add(target, scaled, dst=target)
+
+def splat_heat_roi(xs, ys, values, w, h, sigma, out=None, stamp=None):
+    """Blurred heat for unique points on a w x h grid, computed only inside the splats' bounding ROI.
+    
+    Returns (heat, (x0, y0, x1, y1)). Stamps a cached Gaussian kernel per point, falling back
+    to GaussianBlur over the ROI when there are too many points to stamp. Stamps mirror at
+    the frame edge like BORDER_REFLECT_101 but round differently from the separable blur, so
+    a few pixels land one 8-bit heat level off a full-frame GaussianBlur. out: a float32
+    buffer of at least h x w that heat is a view into, instead of a new array; stamp: a
+    CompositeBuffers.stamp-style callable giving kernel-sized scratch.
+    """
+    kernel = gaussian_splat_kernel(sigma)
+    r = kernel.shape[0] // 2
+    
+    # One pixel of margin beyond the kernel keeps reflections at the ROI edge empty
+    x0, x1 = max(int(xs.min()) - r - 1, 0), min(int(xs.max()) + r + 2, w)
+    y0, y1 = max(int(ys.min()) - r - 1, 0), min(int(ys.max()) + r + 2, h)
+    if out is None:
+        heat = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+    else:
+        heat = out[:y1 - y0, :x1 - x0]
+        heat.fill(0)
+    
+    # Stamping costs ~k^2 per point while the separable blur is ~2k per ROI pixel but far better vectorized
+    if len(values) * kernel.shape[0] * 32 < heat.size:
+        scratch = stamp(kernel.shape[0]) if stamp else None
+        for x, y, value in zip(xs.tolist(), ys.tolist(), values.tolist()):
+            if value == 0:
+                continue
+            for mx in _mirror_positions(x, w, r):
+                for my in _mirror_positions(y, h, r):
+                    _stamp_kernel(heat, kernel, mx - x0, my - y0, value, scratch)
+    else:
+        heat[ys - y0, xs - x0] = values
+        # Isolated so a view into a larger buffer never reads its neighbours as border pixels
+        cv2.GaussianBlur(heat, (0, 0), sigma, dst=heat, borderType=cv2.BORDER_REFLECT_101 | cv2.BORDER_ISOLATED)
+    
+    return heat, (x0, y0, x1, y1)
+
+def overlay_settings(heat_scale=None):
+    """Overlay options for composite_heatmap from the configured look"""
+    return {'heat_scale': HEAT_SCALE if heat_scale is None else heat_scale, 'base_sigma': BASE_SIGMA,
+            'colormap': getattr(cv2, f"COLORMAP_{COLORMAP.upper()}"), 'opacity': OVERLAY_OPACITY}
+
+def _heat_roi(xs, ys, values, w, h, sigma, heat_scale, buffers=None):
+    """Blurred heat over the ROI the splats cover, as (heat, (x0, y0, x1, y1)), at 1/heat_scale if > 1"""
+    if heat_scale <= 1:
+        return splat_heat_roi(xs, ys, values, w, h, sigma, *((buffers.heat, buffers.stamp) if buffers else ()))
+    
+    low_w, low_h = -(-w // heat_scale), -(-h // heat_scale)
+    low_cells, index = np.unique((ys // heat_scale) * low_w + xs // heat_scale, return_inverse=True)
+    merged = np.bincount(index.ravel(), weights=values, minlength=len(low_cells))
+    lit = merged != 0
+    low_cells, merged = low_cells[lit], merged[lit]
+    low_heat, (lx0, ly0, lx1, ly1) = splat_heat_roi(low_cells % low_w, low_cells // low_w, merged.astype(np.float32),
+                                                    low_w, low_h, sigma / heat_scale,
+                                                    *((buffers.low_heat, buffers.stamp) if buffers else ()))
+    x0, y0 = lx0 * heat_scale, ly0 * heat_scale
+    x1, y1 = min(lx1 * heat_scale, w), min(ly1 * heat_scale, h)
+    size = ((lx1 - lx0) * heat_scale, (ly1 - ly0) * heat_scale)
+    if buffers is None:
+        heat = cv2.resize(low_heat, size, interpolation=cv2.INTER_LINEAR)
+    else:
+        heat = buffers.heat[:size[1], :size[0]]
+        cv2.resize(low_heat, size, dst=heat, interpolation=cv2.INTER_LINEAR)
+    return heat[:y1 - y0, :x1 - x0], (x0, y0, x1, y1)
+
+def _colorize_heat(heat, colormap, buffers=None):
+    """Colormapped heat scaled to its own peak, or None if there is no heat (heat is scaled in place)"""
+    peak = np.max(heat)
+    if peak <= 0:
+        return None
+    if buffers is None:
+        return cv2.applyColorMap((heat / peak * 255).astype(np.uint8), colormap)
+    
+    rh, rw = heat.shape
+    levels, colored = buffers.levels[:rh, :rw], buffers.colored[:rh, :rw]
+    np.divide(heat, peak, out=heat)
+    np.multiply(heat, 255, out=heat)
+    np.copyto(levels, heat, casting='unsafe')  # Truncates like astype(np.uint8)
+    cv2.applyColorMap(levels, colormap, dst=colored)
+    return colored
+
+def composite_heatmap(darkened, xs, ys, values, base_sigma=40, base_resolution=1920, heat_scale=1,
+                      colormap=cv2.COLORMAP_INFERNO, opacity=0.8):
+    """Blend the heatmap for unique points (xs, ys, values) onto an already darkened frame.
+    
+    The heat field is splatted at 1/heat_scale resolution and upsampled only for the
+    colormap and blend, which stay confined to the ROI the splats cover.
+    """
+    if len(values) == 0 or np.sum(values) == 0:
+        return darkened
+    
+    h, w = darkened.shape[:2]
+    heat, (x0, y0, x1, y1) = _heat_roi(xs, ys, values, w, h, heatmap_sigma(w, base_sigma, base_resolution), heat_scale)
+    colored = _colorize_heat(heat, colormap)
+    if colored is None:
+        return darkened
+    
+    result = cv2.add(darkened, _heatmap_tint(opacity, colormap))
+    result[y0:y1, x0:x1] = cv2.addWeighted(darkened[y0:y1, x0:x1], 1.0, colored, opacity, 0)
+    return result
+
+def composite_frame(frame, xs, ys, values, buffers, base_sigma=40, base_resolution=1920, heat_scale=1,
+                    colormap=cv2.COLORMAP_INFERNO, opacity=0.8):
+    """Darken a source frame and blend its heatmap into buffers.output, without allocating frames.
+    
+    Same result as composite_heatmap on the darkened frame: darkening and the no-heat tint are
+    one LUT pass, and the colorize and blend write into the ROI of the output in place.
+    """
+    output = buffers.output
+    if len(values) == 0 or np.sum(values) == 0:
+        return cv2.LUT(frame, _darken_lut(), dst=output)
+    
+    heat, (x0, y0, x1, y1) = _heat_roi(xs, ys, values, buffers.w, buffers.h,
+                                       heatmap_sigma(buffers.w, base_sigma, base_resolution), heat_scale, buffers)
+    colored = _colorize_heat(heat, colormap, buffers)
+    if colored is None:
+        return cv2.LUT(frame, _darken_lut(), dst=output)
+    
+    cv2.LUT(frame, _darken_tint_lut(opacity, colormap), dst=output)
+    roi = output[y0:y1, x0:x1]
+    cv2.LUT(frame[y0:y1, x0:x1], _darken_lut(), dst=roi)
+    cv2.addWeighted(roi, 1.0, colored, opacity, 0, dst=roi)
+    return output
+
+class ClickSchedule:
+    """Clicks as parallel arrays sorted by start frame, swept frame by frame.
+    
+    Every click is lit for the same number of frames (cut short at the end of the video), so
+    sorting by start also sorts by end, and the clicks lit in a frame are one contiguous run.
+    Repeated clicks on a pixel with the same start frame are merged into one entry weighted
+    by their count. order keeps each entry's position in the session, so brightness is summed
+    in float32 in the same order as the dense per-click accumulation and the sums match it
+    exactly; a weighted entry is added weight times in a row.
+    """
+    def __init__(self, starts, ends, cells, order, weights, w):
+        self.starts, self.ends = starts, ends
+        self.cells = cells  # y * w + x
+        self.order = order
+        self.weights = weights
+        self.in_order = bool(np.all(order[1:] > order[:-1]))  # Sessions are usually sorted by time
+        self.merged = bool(len(weights)) and int(weights.max()) > 1
+        self.w = w
+    
+    def __len__(self):
+        return len(self.starts)
+    
+    def window(self, first_frame, last_frame):
+        """The clicks lit anywhere in [first_frame, last_frame), e.g. to ship to a segment worker"""
+        lo = np.searchsorted(self.ends, first_frame, side='right')
+        hi = np.searchsorted(self.starts, last_frame, side='left')
+        return ClickSchedule(self.starts[lo:hi], self.ends[lo:hi], self.cells[lo:hi], self.order[lo:hi],
+                             self.weights[lo:hi], self.w)
+    
+    def iter_frames(self, fade_duration, first_frame, last_frame):
+        """Yield (frame_index, cells, values): each lit pixel once, with its float32 brightness sum"""
+        # Sweep line: frame j lights clicks [ends > j) up to [starts <= j)
+        lo = np.searchsorted(self.ends, np.arange(first_frame, last_frame), side='right')
+        hi = np.searchsorted(self.starts, np.arange(first_frame, last_frame), side='right')
+        empty_cells, empty_values = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
         
-        scale = min(min(max_width / w, max_height / h), 1.0)
-        new_w, new_h = int(w * scale) & ~1, int(h * scale) & ~1
+        for j, a, b in zip(range(first_frame, last_frame), lo.tolist(), hi.tolist()):
+            if a >= b:
+                yield j, empty_cells, empty_values
+                continue
+            # Fade in over the first fade_duration frames, out over the last ones
+            to_end = (self.ends[a:b] - j) / fade_duration
+            from_start = (j - self.starts[a:b]) / fade_duration
+            brightness = np.where(to_end <= 1.0, to_end, np.minimum(from_start, 1.0)).astype(np.float32)
+            
+            cells, index = np.unique(self.cells[a:b], return_inverse=True)
+            weights = self.weights[a:b]
+            if not self.in_order:
+                by_click = np.argsort(self.order[a:b], kind='stable')
+                index, brightness, weights = index[by_click], brightness[by_click], weights[by_click]
+            if self.merged:
+                index, brightness = np.repeat(index, weights), np.repeat(brightness, weights)
+            values = np.zeros(len(cells), dtype=np.float32)
+            np.add.at(values, index, brightness)  # Sequential float32 adds, in click order
+            yield j, cells, values
+
+def build_click_spans(click_data, w, h, fps, frame_count):
+    """Index clicks by pixel and the [start, end) frame span each one is lit for; returns (ClickSchedule, fade_duration)"""
+    fade_duration = int(fps * 0.3)
+    click_x, click_y, timestamps = click_columns(click_data)
+    xs = np.clip((click_x * w).astype(np.int64), 0, w - 1)
+    ys = np.clip((click_y * h).astype(np.int64), 0, h - 1)
+    
+    starts = np.maximum(0, np.trunc(timestamps * fps - fade_duration).astype(np.int64))
+    lit = np.minimum(starts + fade_duration * 2, frame_count) > starts
+    
+    # Merge clicks sharing a pixel and start frame that follow each other among that pixel's
+    # clicks in session order; nothing else is added to the pixel between them, so replaying
+    # the count keeps the float32 sums exact
+    order = np.flatnonzero(lit)
+    cells = ys[order] * w + xs[order]
+    by_cell = np.argsort(cells, kind='stable')
+    order, cells, starts = order[by_cell], cells[by_cell], starts[order][by_cell]
+    heads = np.flatnonzero(np.concatenate([[True], (cells[1:] != cells[:-1]) | (starts[1:] != starts[:-1])]))
+    weights = np.diff(np.append(heads, len(order)))
+    order, cells, starts = order[heads], cells[heads], starts[heads]
+    
+    # Order by start frame, with entries sharing a start in session order
+    by_start = np.lexsort((order, starts))
+    starts = starts[by_start]
+    schedule = ClickSchedule(starts, np.minimum(starts + fade_duration * 2, frame_count),
+                             cells[by_start], order[by_start], weights[by_start], w)
+    return schedule, fade_duration
+
+def iter_frame_brightness(spans, fade_duration, first_frame, last_frame):
+    """Yield (frame_index, cells, values) for every frame: the lit pixels (y * w + x) and their brightness"""
+    return spans.iter_frames(fade_duration, first_frame, last_frame)
+
+def max_frame_brightness(spans, fade_duration, frame_count):
+    """Peak per-pixel brightness over the whole video"""
+    max_brightness = np.float32(0)
+    for _, _, values in iter_frame_brightness(spans, fade_duration, 0, frame_count):
+        if len(values):
+            max_brightness = max(max_brightness, values.max())
+    return max_brightness
+
+def normalize_frame_brightness(cells, values, w, max_brightness):
+    """Convert one frame's cells to (xs, ys, values) arrays with the global sqrt normalization"""
+    cells = cells.astype(np.intp, copy=False)
+    if max_brightness > 1.0:
+        values = np.sqrt(values / max_brightness)
+    return cells % w, cells // w, values
+
+class HeatField:
+    """Per-frame accumulated click brightness for one stimulus video, persisted next to it.
+    
+    Stored as CSR .npy files that load memory-mapped: frame_ptr (frame_count + 1 offsets),
+    cells (y * w + x) and values (float32 brightness sums), plus the aggregate click counts
+    for the final frame (total_cells, total_counts) and the clicks themselves (click_x,
+    click_y, click_timestamp) for the saved tracking data. meta.json keeps the render geometry,
+    the video it belongs to and the session files that contributed (with their participant
+    entries), so the averaged video can be re-rendered without reading any session file.
+    """
+    VERSION = 3
+    ARRAYS = ("frame_ptr", "cells", "values", "total_cells", "total_counts", "click_x", "click_y", "click_timestamp")
+    
+    def __init__(self, meta, frame_ptr, cells, values, total_cells, total_counts,
+                 click_x, click_y, click_timestamp, path=None):
+        self.meta = meta
+        self.frame_ptr, self.cells, self.values = frame_ptr, cells, values
+        self.total_cells, self.total_counts = total_cells, total_counts
+        self.click_x, self.click_y, self.click_timestamp = click_x, click_y, click_timestamp
+        self.path = path
+    
+    def __reduce__(self):
+        # Render workers re-open a saved field instead of receiving its arrays
+        if self.path:
+            return HeatField.load, (self.path,)
+        return HeatField, (self.meta, *(getattr(self, name) for name in self.ARRAYS))
+    
+    @staticmethod
+    def path_for(video_path):
+        return os.path.splitext(video_path)[0] + ".heatfield"
+    
+    @classmethod
+    def build(cls, click_data, geometry, sources):
+        """Accumulate clicks into a new field; geometry holds w, h, fps, frame_count and the video signature"""
+        w, h = geometry["w"], geometry["h"]
+        spans, fade_duration = build_click_spans(click_data, w, h, geometry["fps"], geometry["frame_count"])
+        frame_ptr = np.zeros(geometry["frame_count"] + 1, dtype=np.int64)
+        cells, values = [], []
+        for j, frame_cells, frame_values in iter_frame_brightness(spans, fade_duration, 0, geometry["frame_count"]):
+            # Cells keep iter_frame_brightness order, so renders from the field match renders from clicks
+            cells.append(frame_cells.astype(np.int32))
+            values.append(frame_values)
+            frame_ptr[j + 1] = len(frame_cells)
         
-        if scale >= 0.95: 
-            return input_path, 1.0, 1.0
+        total_grid = click_count_grid(click_data, w, h).ravel()
+        total_cells = np.flatnonzero(total_grid).astype(np.int32)
+        meta = {"version": cls.VERSION, **geometry, "fade_duration": fade_duration, "sources": sources}
+        field = cls(meta, np.cumsum(frame_ptr), np.concatenate(cells) if cells else np.empty(0, np.int32),
+                    np.concatenate(values) if values else np.empty(0, np.float32), total_cells, total_grid[total_cells],
+                    *click_columns(click_data))
+        field.meta["digest"] = field.digest()
+        return field
+    
+    def merged(self, other):
+        """A new field holding this field's and other's contributions (same geometry)"""
+        frame_count = self.meta["frame_count"]
+        size = self.meta["w"] * self.meta["h"]
         
-        reduced_path = input_path.replace('.mp4', '_reduced.mp4')
+        keys = np.concatenate([np.repeat(np.arange(frame_count, dtype=np.int64), np.diff(f.frame_ptr)) * size + f.cells
+                               for f in (self, other)])
+        values = np.concatenate([self.values, other.values])
+        order = np.argsort(keys, kind='stable')
+        keys, start = np.unique(keys[order], return_index=True)
+        values = np.add.reduceat(values[order], start) if len(start) else values
+        frame_ptr = np.concatenate([[0], np.cumsum(np.bincount(keys // size, minlength=frame_count))])
         
-        # Check if input has audio and preserve it
-        probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0', input_path]
-        has_audio = False
-        try:
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            has_audio = 'audio' in result.stdout
-        except:
-            pass
+        total_cells, start = np.unique(np.concatenate([self.total_cells, other.total_cells]), return_inverse=True)
+        total_counts = np.bincount(start, weights=np.concatenate([self.total_counts, other.total_counts])).astype(np.float32)
         
-        if has_audio:
-            cmd = ['ffmpeg', '-i', input_path, '-vf', f'scale={new_w}:{new_h}',
-                   '-c:v', 'libx264', '-c:a', 'aac', '-preset', 'ultrafast', '-crf', str(crf), '-y', reduced_path]
-        else:
-            cmd = ['ffmpeg', '-i', input_path, '-vf', f'scale={new_w}:{new_h}',
-                   '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', str(crf), '-an', '-y', reduced_path]
+        meta = {**self.meta, "sources": {**self.meta["sources"], **other.meta["sources"]}}
+        clicks = (np.concatenate([getattr(self, name), getattr(other, name)])
+                  for name in ("click_x", "click_y", "click_timestamp"))
+        field = HeatField(meta, frame_ptr, (keys % size).astype(np.int32), values.astype(np.float32),
+                          total_cells.astype(np.int32), total_counts, *clicks)
+        field.meta["digest"] = field.digest()
+        return field
+    
+    def digest(self):
+        """Content hash of the accumulated heat, used in render cache keys"""
+        digest = hashlib.sha256(json.dumps([self.meta["w"], self.meta["h"], self.meta["fps"]]).encode())
+        for name in self.ARRAYS:
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return digest.hexdigest()
+    
+    def save(self, path):
+        """Write the field directory atomically (a new directory renamed over the old one)"""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+        self.path = path
+    
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != cls.VERSION:
+            raise ValueError(f"version {meta.get('version')} is out of date")
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in cls.ARRAYS]
+        return cls(meta, *arrays, path=path)
+    
+    def max_brightness(self):
+        return np.max(self.values) if len(self.values) else np.float32(0)
+    
+    def final_grid(self):
+        grid = np.zeros(self.meta["w"] * self.meta["h"], dtype=np.float32)
+        grid[self.total_cells] = self.total_counts
+        return grid.reshape(self.meta["h"], self.meta["w"])
+    
+    def iter_frames(self, first_frame, last_frame):
+        """Yield (frame_index, xs, ys, values) with the raw brightness sums of each frame"""
+        w = self.meta["w"]
+        for j in range(first_frame, last_frame):
+            start, end = int(self.frame_ptr[j]), int(self.frame_ptr[j + 1])
+            cells = np.asarray(self.cells[start:end], dtype=np.intp)
+            yield j, cells % w, cells // w, np.asarray(self.values[start:end])
+
+def iter_frame_points(spans, fade_duration, max_brightness, first_frame, last_frame):
+    """Yield (frame_index, xs, ys, values) normalized per frame, from click spans or a HeatField"""
+    if isinstance(spans, HeatField):
+        for j, xs, ys, values in spans.iter_frames(first_frame, last_frame):
+            if max_brightness > 1.0 and len(values):
+                values = np.sqrt(values / max_brightness)
+            yield j, xs, ys, values
+    else:
+        for j, cells, values in iter_frame_brightness(spans, fade_duration, first_frame, last_frame):
+            yield (j, *normalize_frame_brightness(cells, values, spans.w, max_brightness))
+
+class JobCancelled(Exception):
+    """Raised from a progress callback to abort a render in progress"""
+
+def report_progress(progress_callback, stage, percent):
+    """Log pipeline progress and forward it to an optional (stage, percent) callback"""
+    if stage == 'render':
+        print(f"Video generation: {percent}%")
+    if progress_callback:
+        progress_callback(stage, percent)
+
+def render_heatmap_frames(cap, spans, fade_duration, max_brightness, first_frame, last_frame, write_frame,
+                          frame_count=None, overlay_options=None, progress_callback=None):
+    """Composite frames [first_frame, last_frame) read from cap and pass each to write_frame.
+    
+    Returns (frames_written, last_source_frame) so callers never have to seek back for it.
+    overlay_options are passed through to composite_frame. Frames are decoded and composited
+    into reused buffers, so write_frame must be done with each frame when it returns.
+    Per-frame decode (including the ffmpeg downscale), render and encode times go to stage_metrics.
+    """
+    overlay_options = overlay_options or {}
+    buffers = CompositeBuffers(cap.w, cap.h, overlay_options.get('heat_scale', 1))
+    written = 0
+    last_source = None
+    
+    started = time.perf_counter()
+    for j, xs, ys, values in iter_frame_points(spans, fade_duration, max_brightness, first_frame, last_frame):
+        points_ready = time.perf_counter()
+        # Alternate decode targets so last_source survives the failed read at the end
+        ret, frame = cap.read(buffers.sources[written % 2])
+        if not ret: break
+        decoded = time.perf_counter()
         
-        if subprocess.run(cmd, capture_output=True).returncode == 0:
-            return reduced_path, new_w / w, new_h / h
-        return input_path, 1.0, 1.0
-    except:
-        return input_path, 1.0, 1.0
+        if frame_count and j % (50 if frame.shape[0] * frame.shape[1] < 1000000 else 25) == 0:
+            report_progress(progress_callback, 'render', int(((j - first_frame) / (last_frame - first_frame)) * 100))
+        
+        result = composite_frame(frame, xs, ys, values, buffers, **overlay_options)
+        rendered = time.perf_counter()
+        
+        write_frame(result)
+        written += 1
+        last_source = frame
+        
+        finished = time.perf_counter()
+        stage_metrics.observe("decode", decoded - points_ready)
+        stage_metrics.observe("render", (points_ready - started) + (rendered - decoded))
+        stage_metrics.observe("encode", finished - rendered)
+        started = finished
+    
+    return written, last_source
+
+def click_count_grid(click_data, w, h):
+    """Clicks per pixel over the whole video, for the aggregate final frame"""
+    click_x, click_y, _ = click_columns(click_data)
+    xs, ys = (click_x * w).astype(np.int64), (click_y * h).astype(np.int64)
+    inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+    return np.bincount(ys[inside] * w + xs[inside], minlength=w * h).astype(np.float32).reshape(h, w)
 
-def create_heatmap_overlay(brightness_grid, video_width, video_height, base_sigma=40, base_resolution=1920):
-    if np.sum(brightness_grid) == 0: 
+def render_final_frame(last_frame, click_data, w, h, overlay_options=None, final_grid=None):
+    """Darkened last frame with the aggregate heatmap of every click, or None without clicks.
+    
+    final_grid: precomputed click_count_grid (e.g. from a HeatField) used instead of click_data.
+    """
+    if last_frame is None:
+        last_frame = np.zeros((h, w, 3), dtype=np.uint8)
+    
+    if final_grid is None:
+        final_grid = click_count_grid(click_data, w, h)
+    
+    if np.sum(final_grid) == 0:
         return None
+    if np.max(final_grid) > 1.0:
+        final_grid = np.sqrt(final_grid / np.max(final_grid))
     
-    resolution_scale = video_width / base_resolution
-    scaled_sigma = max(base_sigma * resolution_scale, 5.0)
+    ys, xs = np.nonzero(final_grid)
+    # Darken the last frame and overlay the heatmap
+    darkened_last = cv2.addWeighted(last_frame, 0.5, np.zeros_like(last_frame), 0.5, 0)
+    return composite_heatmap(darkened_last, xs, ys, final_grid[ys, xs], **(overlay_options or {}))
+
+def decode_frames(video_path, frame_indices, w, h, fps):
+    """Decode just the given frames (seeking to each), as {frame_index: BGR frame}"""
+    def decode(j):
+        cap = FfmpegVideoReader(video_path, w, h, start_frame=j, fps=fps, max_frames=1)
+        try:
+            return j, cap.read()[1]
+        finally:
+            cap.release()
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, max(1, len(frame_indices)))) as pool:
+        return dict(pool.map(decode, sorted(set(frame_indices))))
+
+def export_heatmap_images(video_path, click_data, output_dir, filename_base, bin_seconds=None, overlay_options=None):
+    """Write the aggregate heatmap PNG, plus one per bin_seconds time bin, without rendering the video.
+    
+    The aggregate sits on the last frame and each bin on its middle frame, the only frames
+    decoded. Returns [(label, path)], aggregate first; bins without clicks are skipped.
+    """
+    src_w, src_h, fps, frame_count = probe_video(video_path)
+    if not frame_count or not fps:
+        return []
+    w, h = output_size(src_w, src_h)
+    overlay_options = overlay_options or overlay_settings()
+    click_x, click_y, timestamps = click_columns(click_data)
+    
+    images = [("aggregate", frame_count - 1, slice(None))]
+    if bin_seconds:
+        duration = frame_count / fps
+        for k in range(int(np.ceil(duration / bin_seconds))):
+            start, end = k * bin_seconds, min((k + 1) * bin_seconds, duration)
+            in_bin = (timestamps >= start) & (timestamps < end)
+            if in_bin.any():
+                middle = min(int((start + end) / 2 * fps), frame_count - 1)
+                images.append((f"{start:g}s-{end:g}s", middle, in_bin))
     
-    blurred = cv2.GaussianBlur(brightness_grid.astype(np.float32), (0, 0), scaled_sigma)
-    if np.max(blurred) > 0:
-        blurred = (blurred / np.max(blurred) * 255).astype(np.uint8)
-    return cv2.applyColorMap(blurred, cv2.COLORMAP_INFERNO)
+    backgrounds = decode_frames(video_path, [frame for _, frame, _ in images], w, h, fps)
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for label, frame, rows in images:
+        clicks = {'x': click_x[rows], 'y': click_y[rows], 'timestamp': timestamps[rows]}
+        image = render_final_frame(backgrounds.get(frame), clicks, w, h, overlay_options)
+        if image is None:
+            continue
+        suffix = "" if label == "aggregate" else f"_{label}"
+        path = os.path.join(output_dir, f"{filename_base}_heatmap{suffix}.png")
+        cv2.imwrite(path, image)
+        written.append((label, path))
+    return written
+
+def _render_segment(video_path, segment_path, spans, fade_duration, max_brightness, first_frame, last_frame,
+                    fps, w, h, overlay_options=None):
+    """Process pool worker: seek its own decoder and encode [first_frame, last_frame) to segment_path.
+    
+    Returns (frames_written, last_source_frame, stage timings snapshot for the parent's stage_metrics).
+    """
+    stage_metrics.clear()
+    if not os.path.isdir(os.path.dirname(segment_path)):
+        return 0, None, stage_metrics.snapshot()  # The render was cancelled while this chunk was queued
+    cap = FfmpegVideoReader(video_path, w, h, start_frame=first_frame, fps=fps, max_frames=last_frame - first_frame)
+    out = FfmpegVideoWriter(segment_path, w, h, fps, faststart=False)
+    try:
+        written, last_source = render_heatmap_frames(cap, spans, fade_duration, max_brightness,
+                                                     first_frame, last_frame, out.write,
+                                                     overlay_options=overlay_options)
+    finally:
+        cap.release()
+        encoded = out.release()
+    if not encoded:
+        raise RuntimeError(f"Failed to encode segment {segment_path}")
+    return written, last_source, stage_metrics.snapshot()
+
+def render_segments_parallel(video_path, segment_dir, spans, fade_duration, max_brightness, frame_count,
+                             fps, w, h, jobs, overlay_options=None, progress_callback=None, first_frame=0):
+    """Render frames [first_frame, frame_count) as chunks across a process pool.
+    
+    Returns the non-empty segment paths in order and the last decoded source frame.
+    """
+    frames = frame_count - first_frame
+    chunk_count = max(1, min(jobs * 2, frames // 30))
+    bounds = [first_frame + frames * k // chunk_count for k in range(chunk_count + 1)]
+    segments = []
+    
+    # Spawned, not forked: the server's threads may hold locks (e.g. stage_metrics.lock) a fork would inherit
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        futures = []
+        for k in range(chunk_count):
+            first_frame, last_frame = bounds[k], bounds[k + 1]
+            segment_path = os.path.join(segment_dir, f"segment_{k:04d}.mp4")
+            # Ship only the clicks lit inside this chunk (a saved HeatField is re-opened by path)
+            chunk_spans = spans if isinstance(spans, HeatField) else spans.window(first_frame, last_frame)
+            futures.append(pool.submit(_render_segment, video_path, segment_path, chunk_spans, fade_duration,
+                                       max_brightness, first_frame, last_frame, fps, w, h, overlay_options))
+            segments.append(segment_path)
+        
+        done_frames = 0
+        for future in concurrent.futures.as_completed(futures):
+            done_frames += future.result()[0]
+            report_progress(progress_callback, 'render', int(done_frames / frames * 100))
+        results = [future.result() for future in futures]
+    except BaseException:
+        # Drop the queued segments and return without waiting on the ones still rendering
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    
+    last_frame = None
+    for written, last_source, timings in results:
+        stage_metrics.merge(timings)
+        if written:
+            last_frame = last_source
+    return [path for path, (written, _, _) in zip(segments, results) if written > 0], last_frame
+
+def concat_segments(segment_paths, output_path, audio_source=None, audio_duration=None, audio_start=0):
+    """Join same-codec segments without re-encoding, optionally muxing audio_source's audio (as-is when MP4 can hold it)"""
+    list_path = output_path + ".txt"
+    start = time.perf_counter()
+    try:
+        with open(list_path, 'w') as f:
+            for path in segment_paths:
+                f.write(f"file '{path}'\n")
+        
+        cmd = ['ffmpeg', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if audio_source:
+            cmd += _audio_input_args(audio_source, audio_duration, audio_start) + _audio_codec_args(audio_source)
+        cmd += ['-c:v', 'copy', '-movflags', '+faststart', '-y', output_path]
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            print(f"Failed to join segments: {result.stderr.decode(errors='replace')}")
+        return result.returncode == 0
+    finally:
+        stage_metrics.observe("audio_merge" if audio_source else "concat", time.perf_counter() - start)
+        try:
+            os.unlink(list_path)
+        except:
+            pass
 
 def generate_filename(tracking_data, suffix=""):
     timestamp = tracking_data.get('timestamp', datetime.now().strftime("%Y%m%d_%H%M%S"))
@@ -446,54 +1887,43 @@ def save_tracking_data(tracking_data, filename_base):
         json_path = os.path.join(OUTPUT_DIR, f"{filename_base}_data.json")
         
         with open(json_path, 'w') as f:
-            json.dump(tracking_data, f, indent=2)
+            # Averaged renders carry their clicks as NumPy columns
+            json.dump(tracking_data, f, indent=2, default=lambda o: o.tolist() if isinstance(o, np.ndarray) else str(o))
         
         return json_path
     except Exception as e:
         print(f"Error saving tracking data: {e}")
         return None
 
-def generate_averaged_heatmap(video_path, all_click_data, output_folder=None):
-    """Generate averaged heatmap by reusing existing generate_heatmap function"""
+def generate_averaged_heatmap(video_path, heat_field, output_folder=None):
+    """Generate averaged heatmap by reusing existing generate_heatmap function.
+    
+    heat_field: the folder's HeatField (see update_heat_field).
+    """
     if output_folder is None:
         output_folder = OUTPUT_DIR
     
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    sources = heat_field.meta["sources"]
     
     # Create fake tracking_data that mimics the expected format
     tracking_data = {
-        'click_data': all_click_data,
+        'click_data': {'x': heat_field.click_x, 'y': heat_field.click_y, 'timestamp': heat_field.click_timestamp},
+        'source_files': sorted(sources),
         'user_name': 'averaged',
         'tracking_type': 'heatmap',
         'timestamp': timestamp
     }
     
     # Use existing generate_heatmap function
-    temp_output = generate_heatmap(video_path, tracking_data)
+    temp_output = generate_heatmap(video_path, tracking_data, heat_field=heat_field)
     
     if temp_output and os.path.exists(temp_output):
         # Move to final location with timestamped name
         final_video_path = os.path.join(output_folder, f"averaged_heatmap_{timestamp}.mp4")
         shutil.move(temp_output, final_video_path)
         
-        # Load data from original JSON files
-        folder_path = os.path.dirname(video_path)
-        participants = []
-        
-        for json_file in glob.glob(os.path.join(folder_path, "*.json")):
-            try:
-                with open(json_file, 'r') as f:
-                    data = json.load(f)
-                
-                if 'user_name' in data and 'precision_score' in data and 'click_data' in data:
-                    participants.append({
-                        "user_name": data['user_name'],
-                        "click_count": len(data['click_data']),
-                        "precision_score": data['precision_score']
-                    })
-            except Exception as e:
-                print(f"Error processing {json_file}: {e}")
-        
+        participants = [sources[name]["participant"] for name in sorted(sources) if sources[name]["participant"]]
         summary_data = {
             "participant_count": len(participants),
             "video_name": os.path.basename(video_path),
@@ -511,19 +1941,102 @@ def generate_averaged_heatmap(video_path, all_click_data, output_folder=None):
     
     return None
 
-def process_folder(folder_path):
-    """Process a folder containing JSON files and video to generate averaged heatmap"""    
-    if not os.path.exists(folder_path):
-        print(f"Error: Folder {folder_path} does not exist")
+def _file_signature(path):
+    st = os.stat(path)
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+def update_heat_field(folder_path, video_path):
+    """Bring the HeatField next to video_path up to date with the folder's session files.
+    
+    Unchanged inputs reuse the saved field without reading any session file; new files are
+    parsed and merged in on their own; a changed or removed file, or another video, rebuilds
+    it. Returns the field, or None when the folder has no clicks.
+    """
+    src_w, src_h, fps, frame_count = probe_video(video_path)
+    if not frame_count or not fps:
+        print(f"Could not read video {video_path}")
         return None
+    w, h = output_size(src_w, src_h)
+    geometry = {"w": w, "h": h, "fps": fps, "frame_count": frame_count,
+                "video": {"name": os.path.basename(video_path), **_file_signature(video_path)}}
     
-    # Load all JSON files
-    all_click_data = load_json_files(folder_path)
+    current = {os.path.basename(path): _file_signature(path) for path in list_session_files(folder_path)}
+    field_path = HeatField.path_for(video_path)
+    field = None
+    if os.path.exists(field_path):
+        try:
+            field = HeatField.load(field_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring heat field {field_path}: {e}")
+    if field is not None and (field.meta.get("version") != HeatField.VERSION
+                              or any(field.meta.get(k) != v for k, v in geometry.items())):
+        field = None
     
-    if not all_click_data:
-        print("No valid click data found in JSON files")
+    if field is not None:
+        known = {name: {k: entry[k] for k in ("mtime_ns", "size")} for name, entry in field.meta["sources"].items()}
+        added = sorted(set(current) - set(known))
+        if all(current.get(name) == signature for name, signature in known.items()):
+            if not added:
+                print(f"Heat field is up to date ({len(known)} session files)")
+                return field
+            print(f"Adding {len(added)} new session files to the heat field")
+            columns = [[], [], []]
+            sources = {}
+            for name in added:
+                try:
+                    *clicks, participant = _parse_session_file(os.path.join(folder_path, name))
+                except Exception as e:
+                    print(f"Error processing {name}: {e}")
+                    continue
+                for column, values in zip(columns, clicks):
+                    column.append(values)
+                sources[name] = {**current[name], "participant": participant}
+            if sources:
+                click_data = dict(zip(('x', 'y', 'timestamp'), (np.concatenate(c) for c in columns)))
+                field = field.merged(HeatField.build(click_data, geometry, sources))
+            _save_heat_field(field, field_path)
+            return field
+        print("Session files changed or were removed, rebuilding the heat field")
+    
+    sessions = load_json_files(folder_path)
+    if not len(sessions['x']):
+        return None
+    participants = {entry: None for entry in sessions['sources']}
+    for index, participant in zip(sessions['participant_source'], sessions['participants']):
+        participants[sessions['sources'][index]] = participant
+    sources = {name: {**current[name], "participant": participants[name]} for name in sessions['sources'] if name in current}
+    field = HeatField.build(sessions, geometry, sources)
+    _save_heat_field(field, field_path)
+    return field
+
+def _save_heat_field(field, field_path):
+    try:
+        field.save(field_path)
+    except OSError as e:
+        # A read-only stimulus folder still renders, just without the persisted field
+        print(f"Could not save heat field {field_path}: {e}")
+
+def process_folder(folder_path, png=False, bin_seconds=None):
+    """Process a folder containing JSON files and video to generate averaged heatmap.
+    
+    png: write the aggregate (and per-bin) heatmap images instead of the video.
+    """    
+    if not os.path.exists(folder_path):
+        print(f"Error: Folder {folder_path} does not exist")
         return None
     
+    if png:
+        video_path = find_video_file(folder_path)
+        sessions = load_json_files(folder_path)
+        if not video_path or not len(sessions['x']):
+            print("Need a video file and click data to export images")
+            return None
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        images = export_heatmap_images(video_path, sessions, OUTPUT_DIR, f"averaged_{timestamp}", bin_seconds)
+        for label, path in images:
+            print(f"Wrote {label} heatmap: {path}")
+        return images[0][1] if images else None
+    
     # Find video file
     video_path = find_video_file(folder_path)
     
@@ -531,8 +2044,15 @@ def process_folder(folder_path):
         print("No video file found in folder")
         return None
     
+    # Accumulate the session files into the video's heat field (only new files are read)
+    heat_field = update_heat_field(folder_path, video_path)
+    
+    if heat_field is None:
+        print("No valid click data found in JSON files")
+        return None
+    
     # Generate averaged heatmap
-    output_path = generate_averaged_heatmap(video_path, all_click_data, OUTPUT_DIR)
+    output_path = generate_averaged_heatmap(video_path, heat_field, OUTPUT_DIR)
     
     if output_path:
         print(f"Successfully generated averaged heatmap: {output_path}")
@@ -541,157 +2061,812 @@ def process_folder(folder_path):
         print("Failed to generate averaged heatmap")
         return None
 
-def generate_heatmap(video_path, tracking_data):
+def find_stimulus_folders(root):
+    """Every folder under root (root included) holding a video and at least one session file"""
+    folders = []
+    for folder, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        if list_video_files(folder) and any(f.endswith(('.json', '.npz')) for f in files):
+            folders.append(folder)
+    return folders
+
+def _batch_inputs(folder):
+    """{name: [mtime_ns, size]} for the files a folder's averaged heatmap is built from"""
+    names = [f for f in os.listdir(folder) if f.endswith(('.json', '.npz'))]
+    names += [os.path.basename(path) for path in list_video_files(folder)]
+    signature = {}
+    for name in sorted(names):
+        st = os.stat(os.path.join(folder, name))
+        signature[name] = [st.st_mtime_ns, st.st_size]
+    return signature
+
+def estimate_render_memory(video_path, session_bytes, jobs):
+    """Rough peak bytes of one folder's render: decode/encode frames and heat fields per render
+    process, plus the parsed clicks (about twice the session files' size)"""
+    w, h = output_size(*probe_video(video_path)[:2]) if os.path.exists(video_path) else (1280, 720)
+    per_process = 80 * 1024**2 + w * h * 3 * 8 + w * h * 4 * 4
+    return per_process * max(1, jobs) + session_bytes * 2
+
+def _init_batch_worker(settings):
+    """Batch pool initializer: carry the CLI settings into spawned workers"""
+    global RENDER_JOBS, HEAT_SCALE, BASE_SIGMA, COLORMAP, OVERLAY_OPACITY
+    RENDER_JOBS = settings['jobs']
+    HEAT_SCALE = settings['heat_scale']
+    BASE_SIGMA, COLORMAP, OVERLAY_OPACITY = settings['base_sigma'], settings['colormap'], settings['opacity']
+    heatmap_cache.max_bytes = settings['cache_bytes']
+
+def _batch_render_folder(folder, output_dir, inputs):
+    """Batch worker: render one stimulus folder into output_dir and return its report entry"""
+    global OUTPUT_DIR
+    # Intermediate files go to the folder's own output dir so concurrent folders never collide
+    OUTPUT_DIR = output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    entry = {"status": "failed"}
+    start = time.perf_counter()
     try:
-        reduced_path, scale_x, scale_y = reduce_video_quality(video_path)
+        video_path = list_video_files(folder)[0]
+        heat_field = update_heat_field(folder, video_path)
+        entry["ingest_seconds"] = round(time.perf_counter() - start, 3)
+        if heat_field is None:
+            entry["error"] = "no valid click data"
+            return entry
+        sources = heat_field.meta["sources"]
+        entry["clicks"] = int(heat_field.total_counts.sum())
+        entry["participants"] = sum(1 for source in sources.values() if source["participant"])
         
-        filename_base = generate_filename(tracking_data)
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        output_path = os.path.join(OUTPUT_DIR, f"{filename_base}_heatmap.mp4")
+        render_start = time.perf_counter()
+        output_path = generate_averaged_heatmap(video_path, heat_field, output_dir)
+        entry["render_seconds"] = round(time.perf_counter() - render_start, 3)
+        if not output_path:
+            entry["error"] = "render failed"
+            return entry
         
-        save_tracking_data(tracking_data, filename_base)
+        entry.update(status="rendered", output=output_path)
+        with open(os.path.join(output_dir, "batch_state.json"), 'w') as f:
+            json.dump({"inputs": inputs, "output": output_path, "settings": _batch_settings()}, f, indent=2)
+        return entry
+    except Exception as e:
+        entry["error"] = str(e)
+        return entry
+    finally:
+        entry["seconds"] = round(time.perf_counter() - start, 3)
+
+def _batch_settings():
+    """Render settings that make an earlier batch output stale when they change"""
+    return {"heat_scale": HEAT_SCALE, "base_sigma": BASE_SIGMA, "colormap": COLORMAP, "opacity": OVERLAY_OPACITY}
+
+def process_batch(root, workers=2, memory_budget=4 * 1024**3, force=False):
+    """Render every stimulus folder under root, several at a time, and write a JSON run report.
+    
+    Folders run on a process pool of `workers`, and only while their estimated render memory
+    fits in memory_budget bytes (a folder over budget runs alone). Folders whose inputs and
+    settings match their last batch output are skipped unless force is set.
+    Returns (report path, report).
+    """
+    root = os.path.abspath(root)
+    output_root = os.path.join(OUTPUT_DIR, "batch", os.path.basename(root.rstrip(os.sep)))
+    started = datetime.now()
+    run_start = time.perf_counter()
+    folders = find_stimulus_folders(root)
+    print(f"Found {len(folders)} stimulus folders under {root}")
+    
+    entries = []
+    pending = []
+    for folder in folders:
+        relative = os.path.relpath(folder, root)
+        output_dir = os.path.normpath(os.path.join(output_root, relative))
+        entry = {"folder": relative, "output_dir": output_dir}
+        entries.append(entry)
         
-        cap = cv2.VideoCapture(reduced_path)
-        if not cap.isOpened(): 
-            return None
+        videos = list_video_files(folder)
+        if len(videos) > 1:
+            entry.update(status="skipped", error=f"{len(videos)} videos in one folder: {', '.join(map(os.path.basename, videos))}")
+            continue
         
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        inputs = _batch_inputs(folder)
+        try:
+            with open(os.path.join(output_dir, "batch_state.json")) as f:
+                state = json.load(f)
+            up_to_date = (state["inputs"] == inputs and state["settings"] == _batch_settings()
+                          and os.path.exists(state["output"]))
+        except (OSError, ValueError, KeyError):
+            up_to_date = False
+        if up_to_date and not force:
+            entry.update(status="up_to_date", output=state["output"])
+            continue
         
-        # Create temporary video without audio for processing
-        temp_video_path = output_path.replace('.mp4', '_temp.mp4')
-        out = cv2.VideoWriter(temp_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-        fade_duration = int(fps * 0.3)
+        session_bytes = sum(size for name, (_, size) in inputs.items() if name.endswith(('.json', '.npz')))
+        entry["estimated_mb"] = round(estimate_render_memory(videos[0], session_bytes, RENDER_JOBS) / 1024**2, 1)
+        pending.append((entry, folder, output_dir, inputs))
+    
+    # Largest folders first so a big one isn't left to run alone at the end
+    pending.sort(key=lambda item: -item[0]["estimated_mb"])
+    budget_mb = memory_budget / 1024**2
+    settings = {'jobs': RENDER_JOBS, 'cache_bytes': heatmap_cache.max_bytes, **_batch_settings()}
+    
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_batch_worker,
+                                                initargs=(settings,)) as pool:
+        running = {}
+        in_use_mb = 0.0
+        while pending or running:
+            # Start folders while workers are free and their estimates fit the memory budget
+            while pending and len(running) < workers:
+                index = next((i for i, item in enumerate(pending) if in_use_mb + item[0]["estimated_mb"] <= budget_mb), None)
+                if index is None and not running:
+                    index = 0
+                if index is None:
+                    break
+                entry, folder, output_dir, inputs = pending.pop(index)
+                print(f"Rendering {entry['folder']} (~{entry['estimated_mb']} MB)")
+                running[pool.submit(_batch_render_folder, folder, output_dir, inputs)] = entry
+                in_use_mb += entry["estimated_mb"]
+            
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                entry = running.pop(future)
+                in_use_mb -= entry["estimated_mb"]
+                try:
+                    entry.update(future.result())
+                except Exception as e:
+                    entry.update(status="failed", error=str(e))
+                print(f"{entry['folder']}: {entry['status']}" + (f" ({entry['error']})" if entry.get("error") else ""))
+    
+    counts = {}
+    for entry in entries:
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    report = {
+        "root": root,
+        "started": started.isoformat(timespec='seconds'),
+        "seconds": round(time.perf_counter() - run_start, 3),
+        "settings": {**_batch_settings(), "jobs": RENDER_JOBS, "workers": workers,
+                     "memory_budget_mb": round(budget_mb), "force": force},
+        "counts": counts,
+        "folders": entries
+    }
+    os.makedirs(output_root, exist_ok=True)
+    report_path = os.path.join(output_root, f"batch_report_{started.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Batch finished in {report['seconds']}s: {counts}. Report: {report_path}")
+    return report_path, report
+
+def render_range(start, end, fps, frame_count):
+    """[first, last) frame indices covering start to end seconds (None for either end of the video)"""
+    first = min(max(int(start * fps), 0), frame_count) if start is not None else 0
+    last = min(max(int(np.ceil(end * fps)), 0), frame_count) if end is not None else frame_count
+    return first, last
+
+def generate_heatmap(video_path, tracking_data, jobs=None, heat_scale=None, progress_callback=None, upload=None,
+                     heat_field=None, start=None, end=None, quality="full"):
+    """Render the heatmap video for video_path and return its path, or None on failure.
+    
+    upload: the UploadSession video_path is spooled by. If it is still receiving a fast-start
+    MP4, decoding follows the upload instead of waiting for the last chunk.
+    heat_field: a HeatField for video_path to render from instead of tracking_data's clicks.
+    start, end: seconds of the video to render; the decoder seeks to start and only clicks in the
+    window count. A heat_field is cut to the window, but its final frame still holds every click.
+    quality: "preview" renders a quick draft at PREVIEW_SIZE and PREVIEW_FPS with a fast encoder
+    preset (serially, from clicks only).
+    """
+    partial_output = None  # Set while an encoder may have left a truncated file at output_path
+    try:
+        live_upload = None
+        if upload is not None:
+            report_progress(progress_callback, 'upload', 0)
+            if upload.wait_streamable():
+                live_upload = upload
+            elif not upload.wait_complete():
+                print("Upload was not completed")
+                return None
         
-        click_data = tracking_data.get('click_data', [])
-        brightness_per_frame = np.zeros((frame_count, h, w), dtype=np.float32)
+        report_progress(progress_callback, 'probe', 0)
+        src_w, src_h, fps, frame_count = probe_video(video_path)
+        if live_upload and not frame_count:
+            # Fragmented MP4 headers carry no frame count, so wait for the whole file
+            live_upload = None
+            if not upload.wait_complete():
+                return None
+            src_w, src_h, fps, frame_count = probe_video(video_path)
+        if not frame_count or not fps:
+            return None
         
-        for click in click_data:
-            x, y = int(float(click["x"]) * w), int(float(click["y"]) * h)
-            x, y = min(max(x, 0), w - 1), min(max(y, 0), h - 1)
-            
-            start_frame = max(0, int((click["timestamp"] * fps) - fade_duration))
-            end_frame = min(start_frame + fade_duration * 2, frame_count)
-            
-            frame_range = np.arange(start_frame, end_frame)
-            fade_in = frame_range < start_frame + fade_duration
-            fade_out = frame_range >= end_frame - fade_duration
-            
-            brightness = np.ones_like(frame_range, dtype=np.float32)
-            brightness[fade_in] = (frame_range[fade_in] - start_frame) / fade_duration
-            brightness[fade_out] = (end_frame - frame_range[fade_out]) / fade_duration
-            
-            brightness_per_frame[frame_range, y, x] += brightness
+        preview = quality == "preview"
+        if preview and heat_field is not None:
+            raise ValueError("A heat field can't be rendered as a preview")
+        w, h = output_size(src_w, src_h, *(PREVIEW_SIZE if preview else ()))
+        resample = preview and fps > PREVIEW_FPS
+        if resample:
+            # Frames are counted at the preview rate from here on; the decoder drops the rest
+            frame_count, fps = max(1, int(frame_count * PREVIEW_FPS / fps)), PREVIEW_FPS
+        first_frame, end_frame = render_range(start, end, fps, frame_count)
+        if first_frame >= end_frame:
+            print(f"Nothing to render between {start}s and {end}s")
+            return None
+        windowed = (first_frame, end_frame) != (0, frame_count)
         
-        max_brightness = np.max(brightness_per_frame)
-        if max_brightness > 1.0:
-            brightness_per_frame = np.sqrt(brightness_per_frame / max_brightness)
+        filename_base = generate_filename(tracking_data)
+        suffix = (f"_{first_frame / fps:g}-{end_frame / fps:g}s" if windowed else "") + ("_preview" if preview else "")
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        output_path = os.path.join(OUTPUT_DIR, f"{filename_base}_heatmap{suffix}.mp4")
         
-        batch_size = 50 if w * h < 1000000 else 25
-        for i in range(0, frame_count, batch_size):
-            batch_end = min(i + batch_size, frame_count)
-            progress = int((i / frame_count) * 100)
-            print(f"Video generation: {progress}%")
-            
-            for j in range(i, batch_end):
-                ret, frame = cap.read()
-                if not ret: break
-                
-                darkened = cv2.addWeighted(frame, 0.5, np.zeros_like(frame), 0.5, 0)
-                heatmap = create_heatmap_overlay(brightness_per_frame[j], w, h)
-                
-                if heatmap is not None:
-                    result = cv2.addWeighted(darkened, 1.0, heatmap, 0.8, 0)
-                else:
-                    result = darkened
-                
-                out.write(result)
-        
-        # Get the last frame for final heatmap overlay
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count - 1)
-        ret, last_frame = cap.read()
-        if not ret:
-            # If we can't get the last frame, reset to beginning and read through
-            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-            for _ in range(frame_count):
-                ret, last_frame = cap.read()
-                if not ret:
-                    last_frame = np.zeros((h, w, 3), dtype=np.uint8)
-                    break
+        if not preview:
+            save_tracking_data(tracking_data, filename_base)
         
-        # Add final heatmap frame with extended duration
-        final_grid = np.zeros((h, w), dtype=np.float32)
-        for click in click_data:
-            x, y = int(float(click["x"]) * w), int(float(click["y"]) * h)
-            if 0 <= x < w and 0 <= y < h:
-                final_grid[y, x] += 1
-        
-        if np.sum(final_grid) > 0:
-            if np.max(final_grid) > 1.0:
-                final_grid = np.sqrt(final_grid / np.max(final_grid))
-            final_heatmap = create_heatmap_overlay(final_grid, w, h)
-            if final_heatmap is not None:
-                # Darken the last frame and overlay the heatmap
-                darkened_last = cv2.addWeighted(last_frame, 0.5, np.zeros_like(last_frame), 0.5, 0)
-                final_frame = cv2.addWeighted(darkened_last, 1.0, final_heatmap, 0.8, 0)
-                
-                out.write(final_frame)
+        click_data = tracking_data.get('click_data', [])
+        if windowed:
+            click_x, click_y, timestamps = click_columns(click_data)
+            inside = (timestamps >= first_frame / fps) & (timestamps < end_frame / fps)
+            click_data = {'x': click_x[inside], 'y': click_y[inside], 'timestamp': timestamps[inside]}
+        overlay_options = overlay_settings(heat_scale)
         
-        cap.release()
-        out.release()
+        cache_params = {'size': [w, h], 'fps': fps, 'frame_count': frame_count, **overlay_options}
+        if heat_field is not None:
+            cache_params['heat_field'] = heat_field.meta["digest"]
+        if windowed:
+            cache_params['range'] = [first_frame, end_frame]
+        if preview:
+            cache_params['quality'] = quality
+        cache_key = None
+        if heatmap_cache.enabled() and live_upload is None:
+            report_progress(progress_callback, 'cache', 0)
+            cache_key = heatmap_cache.key(video_path, click_data, cache_params,
+                                          video_digest=upload.sha256() if upload else None)
+            if heatmap_cache.fetch(cache_key, output_path):
+                print("Heatmap served from cache")
+                return output_path
         
-        # Check if original video has audio and merge it
-        probe_cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a', '-show_entries', 'stream=codec_type', '-of', 'csv=p=0', reduced_path]
-        has_audio = False
-        try:
-            result = subprocess.run(probe_cmd, capture_output=True, text=True)
-            has_audio = 'audio' in result.stdout
-        except:
-            pass
+        with stage_metrics.time("rasterize"):
+            if heat_field is not None:
+                spans, fade_duration = heat_field, heat_field.meta["fade_duration"]
+                max_brightness = heat_field.max_brightness()
+                final_grid = heat_field.final_grid()
+            else:
+                spans, fade_duration = build_click_spans(click_data, w, h, fps, frame_count)
+                # First pass only tracks the peak so the sqrt normalization stays global
+                max_brightness = max_frame_brightness(spans, fade_duration, frame_count)
+                final_grid = None
         
-        if has_audio:
-            # Get duration of temp video to ensure audio sync
-            duration_cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', '-of', 'csv=p=0', temp_video_path]
+        # Audio is cut to the rendered window, which runs one aggregate frame past the source
+        audio_start, audio_duration = first_frame / fps, (end_frame - first_frame + 1) / fps
+        encoder = {'preset': 'ultrafast', 'crf': 28} if preview else {}
+        
+        jobs = RENDER_JOBS if jobs is None else jobs
+        if jobs > 1 and end_frame - first_frame > 1 and live_upload is None and not preview:
+            segment_dir = tempfile.mkdtemp(prefix="heatmap_segments_")
             try:
-                duration_result = subprocess.run(duration_cmd, capture_output=True, text=True)
-                temp_duration = float(duration_result.stdout.strip())
+                segment_paths, last_frame = render_segments_parallel(video_path, segment_dir, spans, fade_duration,
+                                                                     max_brightness, end_frame, fps, w, h, jobs,
+                                                                     overlay_options, progress_callback, first_frame)
+                final_frame = render_final_frame(last_frame, click_data, w, h, overlay_options, final_grid)
+                if final_frame is not None:
+                    final_path = os.path.join(segment_dir, "final.mp4")
+                    out = FfmpegVideoWriter(final_path, w, h, fps, faststart=False)
+                    out.write(final_frame)
+                    if out.release():
+                        segment_paths.append(final_path)
                 
-                # Merge video with audio
-                merge_cmd = [
-                    'ffmpeg', '-i', temp_video_path, '-i', reduced_path,
-                    '-c:v', 'libx264', '-c:a', 'aac', '-map', '0:v:0', '-map', '1:a:0',
-                    '-t', str(temp_duration), 
-                    '-y', output_path
-                ]
-                result = subprocess.run(merge_cmd, capture_output=True)
-                if result.returncode == 0:
-                    os.unlink(temp_video_path)
-                    print("Audio merged successfully")
-                else:
-                    print(f"Failed to merge audio: {result.stderr.decode() if result.stderr else 'Unknown error'}")
-                    shutil.move(temp_video_path, output_path)
-                    
-            except Exception as e:
-                print(f"Error during audio merge: {e}")
-                shutil.move(temp_video_path, output_path)
+                # Join the segments and mux the original audio in one stream-copy pass
+                report_progress(progress_callback, 'mux', 100)
+                partial_output = output_path
+                if not concat_segments(segment_paths, output_path, audio_source=video_path, audio_duration=audio_duration,
+                                       audio_start=audio_start):
+                    print("Failed to join rendered segments")
+                    return None
+            finally:
+                shutil.rmtree(segment_dir, ignore_errors=True)
         else:
-            print("No audio found in original video")
-            shutil.move(temp_video_path, output_path)
+            if live_upload:
+                # The source is still arriving, so encode video only and mux its audio once it's complete
+                video_only_path = os.path.join(tempfile.gettempdir(), f"{filename_base}_{uuid.uuid4().hex[:8]}_video.mp4")
+                cap = FfmpegVideoReader(video_path, w, h, first_frame, fps, end_frame - first_frame,
+                                        feed=live_upload.follow(), resample=resample)
+                out = FfmpegVideoWriter(video_only_path, w, h, fps, faststart=False, **encoder)
+            else:
+                cap = FfmpegVideoReader(video_path, w, h, first_frame, fps, end_frame - first_frame, resample=resample)
+                partial_output = output_path
+                out = FfmpegVideoWriter(output_path, w, h, fps, audio_source=video_path, audio_duration=audio_duration,
+                                        audio_start=audio_start, **encoder)
+            try:
+                _, last_frame = render_heatmap_frames(cap, spans, fade_duration, max_brightness, first_frame, end_frame,
+                                                      out.write, frame_count=frame_count,
+                                                      overlay_options=overlay_options,
+                                                      progress_callback=progress_callback)
+                
+                # Add final heatmap frame with extended duration
+                report_progress(progress_callback, 'finalize', 100)
+                final_frame = render_final_frame(last_frame, click_data, w, h, overlay_options, final_grid)
+                if final_frame is not None:
+                    out.write(final_frame)
+            finally:
+                cap.release()
+                encoded = out.release()
+            
+            if live_upload:
+                try:
+                    if not (encoded and live_upload.wait_complete()):
+                        return None
+                    report_progress(progress_callback, 'mux', 100)
+                    partial_output = output_path
+                    if not concat_segments([video_only_path], output_path, audio_source=video_path,
+                                           audio_duration=audio_duration, audio_start=audio_start):
+                        return None
+                    if heatmap_cache.enabled():
+                        cache_key = heatmap_cache.key(video_path, click_data, cache_params,
+                                                      video_digest=live_upload.sha256())
+                finally:
+                    try:
+                        os.unlink(video_only_path)
+                    except OSError:
+                        pass
+            elif not encoded:
+                return None
         
-        if reduced_path != video_path:
-            try: 
-                os.unlink(reduced_path)
-            except: 
-                pass
+        partial_output = None
+        if cache_key:
+            heatmap_cache.store(cache_key, output_path)
         
         print("Heatmap generation completed")
         return output_path
         
+    except JobCancelled:
+        print("Heatmap generation cancelled")
+        return None
     except Exception as e:
         print(f"Error generating heatmap: {e}")
         return None
+    finally:
+        if partial_output:
+            # Don't leave a truncated MP4 in OUTPUT_DIR after a cancel or a failed encode
+            try:
+                os.unlink(partial_output)
+            except OSError:
+                pass
       
+class HeatmapCache:
+    """On-disk LRU cache of rendered heatmaps keyed by the input video, clicks and render settings"""
+    # Bump when a rendering change makes previously cached videos stale
+    RENDER_VERSION = 4
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    def key(self, video_path, click_data, params, video_digest=None):
+        """sha256 over the video's sha256, the normalized clicks and the render parameters"""
+        if video_digest is None:
+            video_hash = hashlib.sha256()
+            with open(video_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    video_hash.update(block)
+            video_digest = video_hash.hexdigest()
+        digest = hashlib.sha256(video_digest.encode())
+        
+        x, y, t = (column.tolist() for column in click_columns(click_data))
+        clicks = sorted((round(cx, 6), round(cy, 6), round(ct, 4)) for cx, cy, ct in zip(x, y, t))
+        settings = {'version': self.RENDER_VERSION, 'base_sigma': 40, 'base_resolution': 1920,
+                    'fade_seconds': 0.3, **params}
+        digest.update(json.dumps({'clicks': clicks, 'settings': settings}, sort_keys=True).encode())
+        return digest.hexdigest()
+    
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+    
+    def fetch(self, key, output_path):
+        """Materialize a cached render at output_path, returning False on a miss"""
+        entry = self._entry_path(key)
+        try:
+            os.utime(entry)  # Marks the entry most recently used
+            _copy_replace(entry, output_path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return False
+        
+        with self.lock:
+            self.hits += 1
+        return True
+    
+    def store(self, key, output_path):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _copy_replace(output_path, self._entry_path(key))
+            self._evict()
+        except OSError as e:
+            print(f"Failed to cache heatmap: {e}")
+    
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        with self.lock:
+            entries = []
+            for path in glob.glob(os.path.join(self.cache_dir, "*.mp4")):
+                try:
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    pass
+            
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+    
+    def stats(self):
+        with self.lock:
+            entries = glob.glob(os.path.join(self.cache_dir, "*.mp4"))
+            size = sum(os.path.getsize(path) for path in entries if os.path.exists(path))
+            return {"hits": self.hits, "misses": self.misses, "entries": len(entries),
+                    "bytes": size, "max_bytes": self.max_bytes}
+
+def _copy_replace(src, dst):
+    """Copy src over dst through a temp file, so dst is never seen half written.
+    
+    Cache entries are copied rather than hard linked: the encoders rewrite output paths in
+    place (ffmpeg -y truncates), which would corrupt an entry sharing the file.
+    """
+    temp_path = f"{dst}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+    except OSError:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+# Global rendered heatmap cache
+heatmap_cache = HeatmapCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+def _mp4_layout(path, available):
+    """'faststart' once a complete moov box is seen before mdat, 'moov_last' if mdat comes first,
+    'other' for non-MP4 data, or None if the first `available` bytes can't tell yet"""
+    pos = 0
+    with open(path, 'rb') as f:
+        while pos + 8 <= available:
+            f.seek(pos)
+            header = f.read(16)
+            size, box = struct.unpack('>I4s', header[:8])
+            if not box.isalnum():
+                return 'other'
+            if size == 1:
+                if pos + 16 > available:
+                    return None
+                size = struct.unpack('>Q', header[8:16])[0]
+            
+            if box == b'mdat' or size == 0:
+                return 'moov_last'
+            if box == b'moov':
+                return 'faststart' if pos + size <= available else None
+            if size < 8:
+                return 'other'
+            pos += size
+    return None
+
+class UploadOffsetMismatch(Exception):
+    """A chunk did not start where the upload currently ends"""
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+class UploadSession:
+    """A resumable upload spooled straight to disk, which renders can follow while it arrives"""
+    def __init__(self, upload_id, path, size=None, filename=None):
+        self.id = upload_id
+        self.path = path
+        self.size = size
+        self.filename = filename
+        self.offset = 0
+        self.committed = False
+        self.aborted = False
+        self.job_id = None
+        self.updated_time = time.time()
+        self.hash = hashlib.sha256()
+        self.write_lock = threading.Lock()
+        self.condition = threading.Condition()
+        open(path, 'wb').close()
+    
+    def is_complete(self):
+        return self.size is not None and self.offset >= self.size
+    
+    def append(self, offset, stream, block_size=1024 * 1024):
+        """Write one chunk from stream at offset, returning the new offset"""
+        if not self.write_lock.acquire(blocking=False):
+            raise UploadOffsetMismatch(self.offset)
+        try:
+            if offset != self.offset:
+                raise UploadOffsetMismatch(self.offset)
+            
+            with open(self.path, 'r+b') as f:
+                f.seek(offset)
+                while not self.aborted:
+                    block = stream.read(block_size)
+                    if not block:
+                        break
+                    if self.size is not None and self.offset + len(block) > self.size:
+                        raise ValueError("Chunk runs past the declared upload size")
+                    f.write(block)
+                    f.flush()
+                    self.hash.update(block)
+                    with self.condition:
+                        self.offset += len(block)
+                        self.updated_time = time.time()
+                        self.condition.notify_all()
+            return self.offset
+        finally:
+            self.write_lock.release()
+    
+    def finish(self):
+        """Mark the bytes received so far as the whole upload if no size was declared"""
+        with self.condition:
+            if self.size is None:
+                self.size = self.offset
+            self.condition.notify_all()
+    
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
+    
+    def _wait_for_bytes(self, known_offset):
+        """Wait for data past known_offset; False once the upload ended, aborted or stalled"""
+        with self.condition:
+            while self.offset <= known_offset and not self.is_complete() and not self.aborted:
+                if time.time() - self.updated_time > UPLOAD_STALL_TIMEOUT:
+                    return False
+                self.condition.wait(timeout=1.0)
+            return self.offset > known_offset
+    
+    def wait_complete(self):
+        """Block until every byte has arrived; False if the upload was aborted or stalled"""
+        offset = -1
+        while not self.is_complete():
+            if self.aborted:
+                return False
+            offset = self.offset
+            if not self._wait_for_bytes(offset) and not self.is_complete():
+                return False
+        return not self.aborted
+    
+    def wait_streamable(self):
+        """True if the upload is still arriving but its header already allows decoding from a pipe"""
+        while not self.is_complete() and not self.aborted:
+            offset = self.offset
+            layout = _mp4_layout(self.path, offset)
+            if layout is not None:
+                return layout == 'faststart' and not self.is_complete()
+            if not self._wait_for_bytes(offset):
+                return False
+        return False
+    
+    def follow(self, block_size=1024 * 1024):
+        """Yield the upload's bytes from the start, waiting for new chunks until it ends"""
+        position = 0
+        with open(self.path, 'rb') as f:
+            while not self.aborted:
+                available = self.offset - position
+                if available > 0:
+                    chunk = f.read(min(block_size, available))
+                    position += len(chunk)
+                    yield chunk
+                elif self.is_complete() or not self._wait_for_bytes(position):
+                    return
+    
+    def sha256(self):
+        """Hex digest of the bytes received, computed as they arrived"""
+        return self.hash.hexdigest()
+    
+    def to_dict(self):
+        return {
+            "upload_id": self.id,
+            "offset": self.offset,
+            "size": self.size,
+            "complete": self.is_complete(),
+            "committed": self.committed,
+            "job_id": self.job_id
+        }
+
+class UploadManager:
+    """Tracks resumable upload sessions and drops abandoned ones after a TTL"""
+    def __init__(self, spool_dir, ttl=24 * 3600):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    def create(self, size=None, filename=None):
+        self._reap_expired()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        upload_id = uuid.uuid4().hex
+        session = UploadSession(upload_id, os.path.join(self.spool_dir, f"{upload_id}.mp4"), size, filename)
+        with self.lock:
+            self.sessions[upload_id] = session
+        return session
+    
+    def get(self, upload_id):
+        with self.lock:
+            return self.sessions.get(upload_id)
+    
+    def remove(self, upload_id):
+        with self.lock:
+            session = self.sessions.pop(upload_id, None)
+        if session:
+            session.abort()
+            if not session.committed:
+                try:
+                    os.unlink(session.path)
+                except OSError:
+                    pass
+        return session
+    
+    def _reap_expired(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [upload_id for upload_id, session in self.sessions.items() if session.updated_time < cutoff]
+        for upload_id in expired:
+            self.remove(upload_id)
+
+# Global resumable upload sessions
+upload_manager = UploadManager(UPLOAD_DIR)
+
+class HeatmapJob:
+    """One queued heatmap render and its progress"""
+    def __init__(self, job_id, video_path, tracking_data, cleanup_paths, upload=None, profile=False, options=None):
+        self.id = job_id
+        self.profile = profile  # Dump a cProfile of the render to PROFILE_DIR
+        self.options = dict(options or {})  # start, end and quality passed to generate_heatmap
+        self.video_path = video_path
+        self.upload = upload
+        self.tracking_data = tracking_data
+        self.cleanup_paths = list(cleanup_paths)
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0
+        self.created_time = time.time()
+        self.start_time = None
+        self.finish_time = None
+        self.result_path = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
+    
+    def report(self, stage, percent):
+        """Progress callback handed to generate_heatmap; raises once the job is cancelled"""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        self.stage = stage
+        self.progress = percent
+    
+    def eta_seconds(self):
+        if self.status != "running" or not self.start_time or self.progress <= 0:
+            return None
+        elapsed = time.time() - self.start_time
+        return round(elapsed * (100 - self.progress) / self.progress, 1)
+    
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "eta_seconds": self.eta_seconds(),
+            "created": self.created_time,
+            "started": self.start_time,
+            "finished": self.finish_time,
+            "error": self.error,
+            "options": self.options
+        }
+
+class HeatmapJobManager:
+    """Runs heatmap renders on a bounded worker pool so requests don't have to wait on them"""
+    def __init__(self, max_workers=2, ttl=3600):
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.reaper_thread = None
+    
+    def submit(self, video_path, tracking_data, cleanup_paths=(), upload=None, profile=False, options=None):
+        """Queue a render and return its job right away; cleanup_paths are deleted once it ends"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                      thread_name_prefix="heatmap-job")
+                self.reaper_thread = threading.Thread(target=self._reap_expired, daemon=True)
+                self.reaper_thread.start()
+            
+            job = HeatmapJob(uuid.uuid4().hex[:12], video_path, tracking_data, cleanup_paths, upload, profile, options)
+            self.jobs[job.id] = job
+            job.future = self.executor.submit(self._run, job)
+        return job
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def pending_count(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status in ("queued", "running"))
+    
+    def wait(self, job):
+        """Block until the job ends, returning its result path or None"""
+        try:
+            return job.future.result()
+        except concurrent.futures.CancelledError:
+            return None
+    
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False for unknown or already finished jobs"""
+        job = self.get(job_id)
+        if job is None or job.status not in ("queued", "running"):
+            return False
+        
+        job.cancel_event.set()
+        if job.future.cancel():
+            # Never started, so nothing else will clean up after it
+            self._finish(job, "cancelled")
+        return True
+    
+    def _run(self, job):
+        job.status = "running"
+        job.start_time = time.time()
+        try:
+            with profiled(f"job_{job.id}", job.profile):
+                result = generate_heatmap(job.video_path, job.tracking_data, progress_callback=job.report,
+                                          upload=job.upload, **job.options)
+        except Exception as e:
+            job.error = str(e)
+            result = None
+        
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled")
+            return None
+        if result:
+            job.result_path = result
+            job.progress = 100
+            self._finish(job, "completed")
+        else:
+            job.error = job.error or "Failed to generate heatmap"
+            self._finish(job, "failed")
+        return result
+    
+    def _finish(self, job, status):
+        job.status = status
+        job.stage = status
+        job.finish_time = time.time()
+        for path in job.cleanup_paths:
+            try:
+                os.unlink(path)
+            except:
+                pass
+        job.tracking_data = None
+        job.upload = None
+    
+    def _reap_expired(self):
+        """Forget finished jobs after the TTL (result files in OUTPUT_DIR are kept)"""
+        while True:
+            time.sleep(60)
+            cutoff = time.time() - self.ttl
+            with self.lock:
+                expired = [job_id for job_id, job in self.jobs.items()
+                           if job.finish_time and job.finish_time < cutoff]
+                for job_id in expired:
+                    del self.jobs[job_id]
+
+# Global render job queue
+job_manager = HeatmapJobManager()
+
 def find_free_port():
     """Find a random free port"""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -724,6 +2899,7 @@ def get_local_ip():
 
 def register_service(port):
     try:
+        from zeroconf import ServiceInfo, Zeroconf
         zeroconf = Zeroconf()
         local_ip = get_local_ip()
         hostname = socket.gethostname()
@@ -751,6 +2927,10 @@ def register_service(port):
         print(f"Failed to register service: {e}")
         return None, None
 
+def send_video(path, download_name):
+    """Send an MP4 with ETag and HTTP Range (206) support so players can seek and start early"""
+    return send_file(path, mimetype='video/mp4', download_name=download_name, conditional=True, etag=True)
+
 @app.route('/start_detection', methods=['POST'])
 def start_detection():
     if detection_system.start_detection():
@@ -774,19 +2954,23 @@ def stop_detection():
     
     # Save video and session data
     saved_video_path = detection_system.save_video_to_desktop(tracking_data)
-    session_json_path = detection_system.save_session_data(tracking_data, saved_video_path)
+    session_path = detection_system.save_session_data(tracking_data, saved_video_path)
     
     if return_video and saved_video_path and os.path.exists(saved_video_path):
         # Return video file with session data in headers
         session_data = {}
-        if session_json_path and os.path.exists(session_json_path):
+        if session_path and os.path.exists(session_path):
             try:
-                with open(session_json_path, 'r') as f:
-                    session_data = json.load(f)
+                session_json_path = os.path.splitext(session_path)[0] + ".json"
+                if os.path.exists(session_json_path):
+                    with open(session_json_path, 'r') as f:
+                        session_data = json.load(f)
+                else:
+                    session_data, _, _ = load_session_npz(session_path)
             except:
                 pass
         
-        response = send_file(saved_video_path, mimetype='video/mp4', download_name='object_detection_video.mp4')
+        response = send_video(saved_video_path, 'object_detection_video.mp4')
         
         if session_data:
             response.headers['X-Session-Data'] = json.dumps(session_data)
@@ -797,7 +2981,7 @@ def stop_detection():
             "status": "success",
             "message": "Detection stopped and video saved",
             "video_path": saved_video_path,
-            "session_data_path": session_json_path
+            "session_data_path": session_path
         })
 
 @app.route('/get_detections', methods=['GET'])
@@ -805,13 +2989,47 @@ def get_detections():
     if not detection_system.detection_active:
         return jsonify({"status": "error", "message": "Detection not active"}), 400
     
-    detections = detection_system.get_detections()
+    # Pollers pass the last seq they saw; nothing new means an empty 304
+    since = request.args.get('since', type=int)
+    if since is not None and since >= detection_system.detection_seq:
+        return '', 304
+    
+    with detection_system.detection_lock:
+        seq = detection_system.detection_seq
+        detections = detection_system.latest_detections
     return jsonify({
         "status": "success",
+        "seq": seq,
         "detections": detections,
+        "capture": detection_system.frame_ring.stats(),
         "timestamp": time.time()
     })
 
+@app.route('/detections/stream', methods=['GET'])
+def stream_detections():
+    """Server-Sent Events: each new detection set is pushed once, with its seq as the event id"""
+    if not detection_system.detection_active:
+        return jsonify({"status": "error", "message": "Detection not active"}), 400
+    
+    since = request.headers.get('Last-Event-ID', request.args.get('since', detection_system.detection_seq))
+    try:
+        since = int(since)
+    except ValueError:
+        since = detection_system.detection_seq
+    
+    def events(since):
+        yield "retry: 1000\n\n"
+        while detection_system.detection_active:
+            update = detection_system.wait_for_detections(since, timeout=15)
+            if update is None:
+                yield ": keep-alive\n\n"
+                continue
+            since, event = update
+            yield f"id: {since}\nevent: detections\ndata: {event}\n\n"
+    
+    return Response(events(since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 current_recording_process = None
 current_recording_filepath = None
 
@@ -853,7 +3071,7 @@ def start_recording():
             # Merge audio and video
             merge_cmd = [
                 'ffmpeg', '-i', video_filepath, '-i', audio_filepath,
-                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-y', current_recording_filepath
+                '-c:v', 'copy', '-c:a', 'aac', '-shortest', '-movflags', '+faststart', '-y', current_recording_filepath
             ]
             subprocess.run(merge_cmd, capture_output=True)
             
@@ -870,6 +3088,94 @@ def start_recording():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
     
+def _wants_async(data=None):
+    """Whether the client asked for a job id instead of waiting on the render (?async=1 or "async": true)"""
+    flag = request.args.get('async') or (data or {}).get('async') or request.form.get('async')
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+def _wants_profile(data=None):
+    """Whether the client asked for a cProfile dump of this request (?profile=1), honoured with --profile-dir"""
+    flag = request.args.get('profile') or (data or {}).get('profile') or request.form.get('profile')
+    return bool(PROFILE_DIR) and str(flag).lower() in ('1', 'true', 'yes')
+
+def _render_options(data=None):
+    """start/end (seconds) and quality ("full" or "preview") for generate_heatmap from the request.
+    
+    Read like async (query string, JSON body or form); raises ValueError for invalid values.
+    """
+    options = {}
+    for name in ('start', 'end'):
+        value = request.args.get(name) or (data or {}).get(name) or request.form.get(name)
+        if value not in (None, ''):
+            options[name] = float(value)
+            if not options[name] >= 0:
+                raise ValueError(f"{name} must be a non-negative number of seconds")
+    if options.get('end') is not None and options['end'] <= options.get('start', 0):
+        raise ValueError("end must be after start")
+    
+    quality = request.args.get('quality') or (data or {}).get('quality') or request.form.get('quality') or 'full'
+    if quality not in ('full', 'preview'):
+        raise ValueError("quality must be 'full' or 'preview'")
+    if quality == 'preview':
+        options['quality'] = quality
+    return options
+
+def _wants_full_render(data=None):
+    """Whether a preview request also asked for the full-quality render in the background (?full_render=1)"""
+    flag = request.args.get('full_render') or (data or {}).get('full_render') or request.form.get('full_render')
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+def _submit_render(video_path, tracking_data, cleanup_paths, upload=None, data=None):
+    """Queue the render the request asked for; returns (job, full_job), where full_job is the
+    full-quality render queued after a preview with full_render set (or None)"""
+    options = _render_options(data)
+    profile = _wants_profile(data)
+    full_path = None
+    if options.get('quality') == 'preview' and _wants_full_render(data):
+        # The preview deletes its input when it ends, so the full render gets its own link to it
+        full_path = f"{video_path}.full{uuid.uuid4().hex[:8]}"
+        try:
+            os.link(video_path, full_path)
+        except OSError:
+            if upload is not None and not upload.is_complete():
+                print("Could not link the unfinished upload; skipping the full render")
+                full_path = None
+            else:
+                shutil.copyfile(video_path, full_path)
+    
+    job = job_manager.submit(video_path, tracking_data, cleanup_paths, upload=upload, profile=profile, options=options)
+    full_job = None
+    if full_path:
+        full_options = {name: value for name, value in options.items() if name != 'quality'}
+        full_job = job_manager.submit(full_path, tracking_data, cleanup_paths=[full_path], upload=upload,
+                                      profile=profile, options=full_options)
+    return job, full_job
+
+def _heatmap_job_response(job, run_async, full_job=None):
+    """Return the job id right away for async requests, otherwise wait and send the video.
+    
+    A full-quality follow-up render is reported as full_job_id (the X-Full-Job-Id header on videos).
+    """
+    if run_async:
+        body = {
+            "status": "success",
+            "job_id": job.id,
+            "status_url": f"/jobs/{job.id}",
+            "result_url": f"/jobs/{job.id}/result"
+        }
+        if full_job is not None:
+            body.update(full_job_id=full_job.id, full_result_url=f"/jobs/{full_job.id}/result")
+        return jsonify(body), 202
+    
+    heatmap_path = job_manager.wait(job)
+    if heatmap_path:
+        response = send_video(heatmap_path, 'heatmap.mp4')
+        if full_job is not None:
+            response.headers['X-Full-Job-Id'] = full_job.id
+        return response
+    else:
+        return jsonify({"status": "error", "message": job.error or "Failed to generate heatmap"}), 500
+
 @app.route('/stop_recording', methods=['POST'])
 def stop_recording():
     global current_recording_process, current_recording_filepath
@@ -877,6 +3183,7 @@ def stop_recording():
     try:
         data = request.get_json()
         tracking_data = data.get('tracking_data', {})
+        _render_options(data)  # Reject bad start/end/quality before the recording is stopped
                 
         if current_recording_process:
             current_recording_process.terminate()
@@ -885,18 +3192,16 @@ def stop_recording():
             time.sleep(2)
             
             if current_recording_filepath and os.path.exists(current_recording_filepath):
-                heatmap_path = generate_heatmap(current_recording_filepath, tracking_data)
-                os.unlink(current_recording_filepath)
-                
-                if heatmap_path:
-                    return send_file(heatmap_path, mimetype='video/mp4', download_name='heatmap.mp4')
-                else:
-                    return jsonify({"status": "error", "message": "Failed to generate heatmap"}), 500
+                job, full_job = _submit_render(current_recording_filepath, tracking_data,
+                                               [current_recording_filepath], data=data)
+                return _heatmap_job_response(job, _wants_async(data), full_job)
             else:
                 return jsonify({"status": "error", "message": "Recording file not found"}), 500
         else:
             return jsonify({"status": "error", "message": "No active recording"}), 400
-            
+    
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -907,30 +3212,281 @@ def generate_heatmap_endpoint():
         tracking_data = json.loads(request.form.get('tracking_data'))
     
         temp_input = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-        video_file.save(temp_input.name)
+        with stage_metrics.time("upload"):
+            video_file.save(temp_input.name)
+        
+        job, full_job = _submit_render(temp_input.name, tracking_data, [temp_input.name])
+        return _heatmap_job_response(job, _wants_async(), full_job)
+    
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/generate_images', methods=['POST'])
+def generate_images_endpoint():
+    """Heatmap PNGs without rendering the video: the aggregate image, or with bin_seconds a zip
+    holding the aggregate and one image per time bin"""
+    temp_dir = tempfile.mkdtemp(prefix="heatmap_images_")
+    try:
+        video_file = request.files['video']
+        tracking_data = json.loads(request.form.get('tracking_data'))
+        bin_seconds = request.form.get('bin_seconds', type=float)
         
-        heatmap_path = generate_heatmap(temp_input.name, tracking_data)
-        os.unlink(temp_input.name)
+        video_path = os.path.join(temp_dir, "input.mp4")
+        with stage_metrics.time("upload"):
+            video_file.save(video_path)
+        images = export_heatmap_images(video_path, tracking_data.get('click_data', []), temp_dir,
+                                       generate_filename(tracking_data), bin_seconds if bin_seconds and bin_seconds > 0 else None)
+        if not images:
+            return jsonify({"status": "error", "message": "No heatmap could be generated"}), 400
         
-        if heatmap_path:
-            return send_file(heatmap_path, mimetype='video/mp4', download_name='heatmap.mp4')
-        else:
-            return jsonify({"status": "error", "message": "Failed to generate heatmap"}), 500
-            
+        if len(images) == 1 and not bin_seconds:
+            with open(images[0][1], 'rb') as f:
+                return send_file(io.BytesIO(f.read()), mimetype='image/png', download_name='heatmap.png')
+        
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for _, path in images:
+                zf.write(path, os.path.basename(path))
+        archive.seek(0)
+        return send_file(archive, mimetype='application/zip', download_name='heatmaps.zip')
+    
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload; send "size" to let rendering start before the last chunk"""
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if size is not None:
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = -1
+        if size < 0:
+            return jsonify({"status": "error", "message": "size must be a non-negative byte count"}), 400
+    session = upload_manager.create(size, data.get('filename'))
+    return jsonify({"status": "success", **session.to_dict(), "upload_url": f"/uploads/{session.id}"}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def upload_status(upload_id):
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    response = jsonify(session.to_dict())
+    response.headers['Upload-Offset'] = str(session.offset)
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    """Append the raw request body at Upload-Offset (header or ?offset=)"""
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    if session.aborted:
+        return jsonify({"status": "error", "message": "Upload was aborted"}), 410
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Upload-Offset must be a byte offset"}), 400
+    try:
+        with stage_metrics.time("upload"):
+            new_offset = session.append(offset, request.stream)
+    except UploadOffsetMismatch as e:
+        return jsonify({"status": "error", "message": str(e), "offset": e.offset}), 409
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e), "offset": session.offset}), 413
+    
+    response = jsonify({"status": "success", **session.to_dict()})
+    response.headers['Upload-Offset'] = str(new_offset)
+    return response
+
+@app.route('/uploads/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """Render the upload with tracking_data. Committing before the last chunk returns a job id,
+    and a fast-start MP4 is decoded as the remaining chunks arrive."""
+    session = upload_manager.get(upload_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    if session.committed:
+        return jsonify({"status": "error", "message": "Upload already committed", "job_id": session.job_id}), 409
+    
+    data = request.get_json(silent=True) or {}
+    tracking_data = data.get('tracking_data', {})
+    try:
+        if isinstance(tracking_data, str):
+            tracking_data = json.loads(tracking_data)
+        if not isinstance(tracking_data, dict):
+            raise ValueError("tracking_data must be a JSON object")
+        _render_options(data)
+    except ValueError as e:  # json.JSONDecodeError is a ValueError
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    if session.size is None:
+        session.finish()
+    session.committed = True
+    job, full_job = _submit_render(session.path, tracking_data, [session.path], upload=session, data=data)
+    session.job_id = job.id
+    
+    # Waiting here while the client still has chunks to send would deadlock a serial client
+    return _heatmap_job_response(job, _wants_async(data) or not session.is_complete(), full_job)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    session = upload_manager.remove(upload_id)
+    if session is None:
+        return jsonify({"status": "error", "message": "Unknown upload"}), 404
+    return jsonify({"status": "success", "message": "Upload aborted"})
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Same inputs as /generate_heatmap, but always returns a job id immediately"""
+    try:
+        video_file = request.files['video']
+        tracking_data = json.loads(request.form.get('tracking_data'))
+        
+        temp_input = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
+        with stage_metrics.time("upload"):
+            video_file.save(temp_input.name)
+        
+        job, full_job = _submit_render(temp_input.name, tracking_data, [temp_input.name])
+        return _heatmap_job_response(job, True, full_job)
+    
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Endpoints that hand their render to a job: the job thread is profiled, the request only waits on it
+JOB_ENDPOINTS = {'stop_recording', 'generate_heatmap_endpoint', 'commit_upload', 'submit_job'}
+
+@app.before_request
+def start_request_profile():
+    """Profile the request thread for ?profile=1; renders are profiled in their job thread"""
+    if (PROFILE_DIR and request.endpoint not in JOB_ENDPOINTS
+            and str(request.args.get('profile')).lower() in ('1', 'true', 'yes')):
+        g.profile = profiled(f"request_{request.endpoint}")
+        g.profile.__enter__()
+
+@app.teardown_request
+def finish_request_profile(exc=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.__exit__(None, None, None)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Stage latency histograms and pipeline gauges in the Prometheus text format"""
+    capture = detection_system.frame_ring.stats()
+    recordings = sum(1 for process in (detection_system.recording_process, current_recording_process)
+                     if process is not None and process.poll() is None)
+    gauges = [
+        ("itrace_frame_queue_depth", "Captured frames waiting for the detector.", detection_system.frame_ring.depth()),
+        ("itrace_capture_frames_dropped", "Capture frames discarded this detection session (partial reads).",
+         capture["dropped"]),
+        ("itrace_capture_frames_overwritten", "Capture frames replaced before the detector took them this session.",
+         capture["overwritten"]),
+        ("itrace_active_recordings", "Screen recordings in progress.", recordings),
+        ("itrace_pending_render_jobs", "Heatmap renders queued or running.", job_manager.pending_count()),
+    ]
+    lines = []
+    for name, help_text, value in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    body = "\n".join(lines) + "\n" + stage_metrics.render()
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(heatmap_cache.stats())
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    if job.status != "completed":
+        return jsonify({"status": "error", "message": f"Job is {job.status}", "job": job.to_dict()}), 409
+    if not os.path.exists(job.result_path):
+        return jsonify({"status": "error", "message": "Result file no longer exists"}), 410
+    return send_video(job.result_path, 'heatmap.mp4')
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if job_manager.cancel(job_id):
+        return jsonify({"status": "success", "message": "Job cancelled"})
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify({"status": "error", "message": f"Job already {job.status}"}), 409
+
 def main():
+    global RENDER_JOBS, HEAT_SCALE, SESSION_JSON, DETECTOR_PROCESS, COLORMAP, OVERLAY_OPACITY, BASE_SIGMA, PROFILE_DIR
     parser = argparse.ArgumentParser(description='Vision Pro Heatmap Server')
     parser.add_argument('--folder', '-f', type=str, help='Folder path containing JSON files and video to process')
+    parser.add_argument('--batch', '-b', type=str, help='Root directory: render every stimulus folder found under it')
+    parser.add_argument('--batch-workers', type=int, default=2, help='Folders rendered at once in batch mode (default: 2)')
+    parser.add_argument('--batch-memory', type=int, default=4096,
+                        help='Estimated memory budget in MB shared by concurrent batch folders (default: 4096)')
+    parser.add_argument('--force', action='store_true', help='Batch mode: re-render folders whose outputs are up to date')
+    parser.add_argument('--png', action='store_true', help='Folder mode: export heatmap PNGs instead of rendering the video')
+    parser.add_argument('--png-bin', type=float, help='With --png, also write one image per this many seconds')
     parser.add_argument('--server', '-s', action='store_true', help='Start the Flask server (default behavior)')
     parser.add_argument('--port', '-p', type=int, help='Port to run server on (default: random free port)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='Worker processes for heatmap rendering (default: 1)')
+    parser.add_argument('--render-workers', type=int, default=2, help='Heatmap renders the server runs at once (default: 2)')
+    parser.add_argument('--job-ttl', type=int, default=3600, help='Seconds finished jobs stay queryable (default: 3600)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_BYTES // 1024**2,
+                        help='Rendered heatmap cache size in MB, 0 disables (default: 2048)')
+    parser.add_argument('--heat-scale', type=int, default=1, choices=[1, 2, 4, 8],
+                        help='Build the heat field at 1/N resolution before upsampling (default: 1)')
+    parser.add_argument('--colormap', type=str, default=COLORMAP,
+                        choices=sorted(name[len('COLORMAP_'):].lower() for name in dir(cv2) if name.startswith('COLORMAP_')),
+                        help=f'OpenCV colormap for the heat overlay (default: {COLORMAP})')
+    parser.add_argument('--opacity', type=float, default=OVERLAY_OPACITY,
+                        help=f'Heat overlay opacity, 0-1 (default: {OVERLAY_OPACITY})')
+    parser.add_argument('--sigma', type=float, default=BASE_SIGMA,
+                        help=f'Heat blur sigma in pixels at 1920 wide (default: {BASE_SIGMA})')
+    parser.add_argument('--no-session-json', action='store_true',
+                        help='Save detection sessions as .npz only, without the compact JSON copy')
+    parser.add_argument('--detector-process', action='store_true',
+                        help='Run YOLO in a separate process fed through shared memory')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Let requests with ?profile=1 dump a cProfile .prof file into this folder')
     
     args = parser.parse_args()
     
-    if args.folder:
+    RENDER_JOBS = max(1, args.jobs)
+    HEAT_SCALE = args.heat_scale
+    COLORMAP = args.colormap
+    OVERLAY_OPACITY = min(max(args.opacity, 0.0), 1.0)
+    BASE_SIGMA = args.sigma
+    SESSION_JSON = not args.no_session_json
+    DETECTOR_PROCESS = args.detector_process
+    PROFILE_DIR = os.path.expanduser(args.profile_dir) if args.profile_dir else None
+    job_manager.max_workers = max(1, args.render_workers)
+    job_manager.ttl = args.job_ttl
+    heatmap_cache.max_bytes = max(0, args.cache_size) * 1024**2
+    
+    if args.batch:
+        record_startup_time("batch", ready=time.perf_counter() - _PROCESS_START)
+        _, report = process_batch(args.batch, max(1, args.batch_workers), max(1, args.batch_memory) * 1024**2, args.force)
+        sys.exit(1 if report["counts"].get("failed") else 0)
+    elif args.folder:
         # Process folder mode
-        result = process_folder(args.folder)
+        record_startup_time("folder", ready=time.perf_counter() - _PROCESS_START)
+        result = process_folder(args.folder, png=args.png, bin_seconds=args.png_bin)
         if result:
             sys.exit(0)
         else:
@@ -943,6 +3499,11 @@ def main():
         
         zeroconf, service_info = register_service(port)
         
+        # With the debug reloader only the child process (WERKZEUG_RUN_MAIN) serves requests
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            detection_system.warm_up()
+            record_startup_time("server", ready=time.perf_counter() - _PROCESS_START)
+        
         try:
             print(f"Server starting on {local_ip}:{port}")
             app.run(host='0.0.0.0', port=port, debug=True)